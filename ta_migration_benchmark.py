@@ -0,0 +1,429 @@
+"""Offline benchmark for ta_migration_helper.
+
+Generates a synthetic legacy library, replaces TubeArchivist's ElasticSearch helpers
+and yt-dlp with local in-process stand-ins, and times each phase of the helper.
+Nothing outside the generated library is read or changed.
+"""
+import argparse
+import contextlib
+import copy
+import json
+import os
+import random
+import shutil
+import string
+import sys
+import threading
+import time
+import types
+import zlib
+
+PRESETS = {
+    # Channels, videos per channel and subtitle languages for roughly 10k, 100k and 1M files.
+    "10k": (50, 100, ["en"]),
+    "100k": (250, 200, ["en"]),
+    "1m": (1000, 333, ["en", "de"]),
+}
+
+ID_CHARACTERS = string.ascii_letters + string.digits + "-_"
+MP4_HEADER = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom"
+
+
+def parse_args():
+    default_target = "/dev/shm/ta_benchmark" if os.path.isdir("/dev/shm") else "/tmp/ta_benchmark"
+    default_preset = "10k"
+    default_channel_id_files = 0.1
+    default_es_fraction = 0.95
+    default_es_only = 0.01
+    default_es_latency = 0.005
+    default_ytdlp_latency = 0.05
+    default_analysis_only = False
+    default_runs = 1
+    default_seed = 0
+    default_verbose = False
+    default_keep = False
+
+    parser = argparse.ArgumentParser(description="Benchmark ta_migration_helper against a synthetic library. Arguments not listed here are passed on to the helper, e.g. `--YTDLP_WORKERS 4` or `-g`.")
+    parser.add_argument(
+        '-d', '--TARGET_DIR',
+        default=default_target,
+        help="Directory the synthetic library is generated in. It is removed and recreated for every run. Preferably on a tmpfs."
+    )
+    parser.add_argument(
+        '-p', '--PRESET',
+        default=default_preset,
+        choices=sorted(PRESETS),
+        help="Approximate number of files in the library."
+    )
+    parser.add_argument(
+        '--CHANNELS',
+        type=int,
+        help="Number of channels. Overrides the preset."
+    )
+    parser.add_argument(
+        '--VIDEOS_PER_CHANNEL',
+        type=int,
+        help="Number of videos in each channel. Overrides the preset."
+    )
+    parser.add_argument(
+        '--SUB_LANGS',
+        help="Comma separated subtitle languages written for every video, or an empty string for none. Overrides the preset."
+    )
+    parser.add_argument(
+        '--CHANNEL_ID_FILES',
+        type=float,
+        default=default_channel_id_files,
+        help="Fraction of channel directories that contain a `channel.id` file."
+    )
+    parser.add_argument(
+        '--ES_FRACTION',
+        type=float,
+        default=default_es_fraction,
+        help="Fraction of the videos on the filesystem that are also in ElasticSearch. The rest are resolved through yt-dlp."
+    )
+    parser.add_argument(
+        '--ES_ONLY',
+        type=float,
+        default=default_es_only,
+        help="Number of videos only in ElasticSearch, as a fraction of the videos on the filesystem."
+    )
+    parser.add_argument(
+        '--ES_LATENCY',
+        type=float,
+        default=default_es_latency,
+        help="Seconds added to every ElasticSearch request."
+    )
+    parser.add_argument(
+        '--YTDLP_LATENCY',
+        type=float,
+        default=default_ytdlp_latency,
+        help="Seconds added to every yt-dlp lookup."
+    )
+    parser.add_argument(
+        '--ANALYSIS_ONLY',
+        default=default_analysis_only,
+        action='store_true',
+        help="If set to True, the helper runs without PERFORM_MIGRATION, so only loading ElasticSearch, the scan and the comparison are timed."
+    )
+    parser.add_argument(
+        '--RUNS',
+        type=int,
+        default=default_runs,
+        help="Number of times the library is generated and the phases are timed."
+    )
+    parser.add_argument(
+        '--SEED',
+        type=int,
+        default=default_seed,
+        help="Seed of the library generator. The same seed always generates the same library."
+    )
+    parser.add_argument(
+        '--OUTPUT_FILE',
+        help="File the timings of every run are written to as JSON, so they can be compared between versions."
+    )
+    parser.add_argument(
+        '-v', '--VERBOSE',
+        default=default_verbose,
+        action='store_true',
+        help="If set to True, shows the output of the helper instead of discarding it."
+    )
+    parser.add_argument(
+        '--KEEP',
+        default=default_keep,
+        action='store_true',
+        help="If set to True, the library of the last run is left in TARGET_DIR."
+    )
+    global args
+    args, helper_args = parser.parse_known_args()
+    channels, videos_per_channel, sub_langs = PRESETS[args.PRESET]
+    if args.CHANNELS is None:
+        args.CHANNELS = channels
+    if args.VIDEOS_PER_CHANNEL is None:
+        args.VIDEOS_PER_CHANNEL = videos_per_channel
+    args.SUB_LANGS = sub_langs if args.SUB_LANGS is None else [lang for lang in args.SUB_LANGS.split(',') if lang]
+    return helper_args
+
+
+class StandInElasticsearch(object):
+    """In-process replacement for the `ta_video` index, with a fixed latency per request."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.docs = {}
+        self.pit = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def search(self, data):
+        query = (data or {}).get("query", {})
+        if "match" in query:
+            ids = [query["match"]["_id"]]
+        elif "ids" in query:
+            ids = query["ids"]["values"]
+        else:
+            ids = list(self.docs)
+        return {"hits": {"hits": [{"_id": id, "_source": copy.deepcopy(self.docs[id])} for id in ids if id in self.docs]}}
+
+    def open_pit(self):
+        with self.lock:
+            self.pit = sorted(self.docs)
+        return {"id": "benchmark"}
+
+    def pit_search(self, data):
+        # Slices are split on a hash of the ID and pages continue after the last position.
+        sliced = data.get("slice")
+        fields = set(field.split(".")[0] for field in data.get("_source", []))
+        hits = []
+        for position in range(data.get("search_after", [-1])[0] + 1, len(self.pit)):
+            id = self.pit[position]
+            if sliced and zlib.crc32(id.encode()) % sliced["max"] != sliced["id"]:
+                continue
+            doc = self.docs[id]
+            source = {key: copy.deepcopy(value) for key, value in doc.items() if not fields or key in fields}
+            hits.append({"_id": id, "_source": source, "sort": [position]})
+            if len(hits) >= data.get("size", 10):
+                break
+        return {"pit_id": data["pit"]["id"], "hits": {"hits": hits}}
+
+    def mget(self, data):
+        docs = []
+        for id in data["ids"]:
+            if id in self.docs:
+                docs.append({"_id": id, "found": True, "_source": copy.deepcopy(self.docs[id])})
+            else:
+                docs.append({"_id": id, "found": False})
+        return {"docs": docs}
+
+    def bulk(self, data):
+        lines = data.strip().split("\n")
+        items = []
+        for action, doc in zip(lines[::2], lines[1::2]):
+            id = json.loads(action)["update"]["_id"]
+            with self.lock:
+                self.docs[id].update(json.loads(doc)["doc"])
+            items.append({"update": {"_id": id, "status": 200}})
+        return {"errors": False, "items": items}
+
+    def update(self, id, data):
+        with self.lock:
+            self.docs[id].update(data["doc"])
+        return {"_shards": {"total": 1, "successful": 1}}
+
+
+class StandInYoutube(object):
+    """Channel IDs of every generated video, answered after a fixed latency per lookup."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.channels = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+
+def install_stand_ins(es, youtube):
+    """Registers the stand-ins as `home.src.es.connect` and `yt_dlp` before the helper is imported."""
+
+    class ElasticWrap(object):
+        def __init__(self, path):
+            self.path = path
+
+        def get(self, data=False, **kwargs):
+            es.request()
+            path = self.path.split("?")[0]
+            if path.endswith("_mget"):
+                return es.mget(data), 200
+            if path.endswith("_search"):
+                return es.search(data), 200
+            return {}, 404
+
+        def post(self, data=False, ndjson=False):
+            es.request()
+            if self.path.startswith("_bulk"):
+                return es.bulk(data), 200
+            if self.path.split("?")[0].endswith("/_pit"):
+                return es.open_pit(), 200
+            if self.path.startswith("_search") and data and "pit" in data:
+                return es.pit_search(data), 200
+            if "/_update/" in self.path:
+                return es.update(self.path.rsplit("/", 1)[-1], data), 200
+            if self.path.split("?")[0].endswith("_search"):
+                return es.search(data), 200
+            return {}, 404
+
+        def delete(self, data=False, **kwargs):
+            es.request()
+            return {}, 200
+
+    class IndexPaginate(object):
+        def __init__(self, index_name, data, **kwargs):
+            self.data = data
+
+        def get_results(self):
+            es.request()
+            return [copy.deepcopy(doc) for doc in es.docs.values()]
+
+    class DownloadError(Exception):
+        pass
+
+    class YoutubeDL(object):
+        def __init__(self, params=None):
+            self.params = params or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.close()
+
+        def close(self):
+            pass
+
+        def urlopen(self, req):
+            raise NotImplementedError("The stand-in answers lookups without HTTP requests")
+
+        def extract_info(self, url, download=True, process=True, **kwargs):
+            with youtube.lock:
+                youtube.calls += 1
+            if youtube.latency:
+                time.sleep(youtube.latency)
+            video_id = url.rsplit("=", 1)[-1]
+            if video_id not in youtube.channels:
+                raise DownloadError(f"ERROR: [youtube] {video_id}: Video unavailable")
+            return {"id": video_id, "channel_id": youtube.channels[video_id]}
+
+    connect = types.ModuleType("home.src.es.connect")
+    connect.ElasticWrap = ElasticWrap
+    connect.IndexPaginate = IndexPaginate
+    for name in ["home", "home.src", "home.src.es"]:
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["home.src.es.connect"] = connect
+    utils = types.ModuleType("yt_dlp.utils")
+    utils.DownloadError = DownloadError
+    ytdlp = types.ModuleType("yt_dlp")
+    ytdlp.YoutubeDL = YoutubeDL
+    ytdlp.utils = utils
+    sys.modules["yt_dlp"] = ytdlp
+    sys.modules["yt_dlp.utils"] = utils
+
+
+def random_id(rng, length):
+    return ''.join(rng.choice(ID_CHARACTERS) for _ in range(length))
+
+
+def generate_library(target, es, youtube, seed):
+    """Writes a legacy library to `target` and fills the stand-ins with its videos. Returns the number of files."""
+    rng = random.Random(seed)
+    es.docs.clear()
+    youtube.channels.clear()
+    file_count = 0
+    for channel in range(args.CHANNELS):
+        channel_id = "UC" + random_id(rng, 22)
+        channel_dir = os.path.join(target, f"Channel {channel}")
+        os.makedirs(channel_dir)
+        if rng.random() < args.CHANNEL_ID_FILES:
+            with open(os.path.join(channel_dir, "channel.id"), 'w') as f:
+                f.write(f"{channel_id}\n")
+            file_count += 1
+        for video in range(args.VIDEOS_PER_CHANNEL):
+            video_id = random_id(rng, 11)
+            date = f"20{rng.randint(10, 23)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}"
+            base_name = f"{date}_{video_id}_Video {video} of channel {channel}"
+            with open(os.path.join(channel_dir, f"{base_name}.mp4"), 'wb') as f:
+                f.write(MP4_HEADER)
+            subtitles = []
+            for lang in args.SUB_LANGS:
+                with open(os.path.join(channel_dir, f"{base_name}.{lang}.vtt"), 'w') as f:
+                    f.write(f"WEBVTT\nKind: captions\nLanguage: {lang}\n\n")
+                subtitles.append({"ext": "vtt", "lang": lang, "name": lang, "source": "user", "url": "", "media_url": f"Channel {channel}/{base_name}.{lang}.vtt"})
+            file_count += 1 + len(args.SUB_LANGS)
+            youtube.channels[video_id] = channel_id
+            if rng.random() < args.ES_FRACTION:
+                es.docs[video_id] = {"youtube_id": video_id, "media_url": f"Channel {channel}/{base_name}.mp4", "channel": {"channel_id": channel_id}, "subtitles": subtitles}
+    for _ in range(int(args.CHANNELS * args.VIDEOS_PER_CHANNEL * args.ES_ONLY)):
+        video_id = random_id(rng, 11)
+        es.docs[video_id] = {"youtube_id": video_id, "media_url": f"Missing/{video_id}.mp4", "channel": {"channel_id": "UC" + random_id(rng, 22)}, "subtitles": []}
+    return file_count
+
+
+# The helper's metrics phases that make up each benchmark phase.
+PHASES = {
+    "es_load": ["get_video_ids_from_es"],
+    "scan": ["review_filesystem"],
+    "compare": ["compare_es_filesystem"],
+    "migrate": ["plan_migration", "migrate_files"],
+}
+
+
+def run_phases(helper, es, youtube, source_dir):
+    """Runs the helper the way its `main` does and returns the timings of its phases."""
+    helper.metrics = helper.Metrics()
+    es_requests = es.requests
+    youtube_calls = youtube.calls
+    with open(os.devnull, 'w') as devnull, contextlib.nullcontext() if args.VERBOSE else contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        helper.run(source_dir)
+        total = time.perf_counter() - start
+    timings = {}
+    for phase, names in PHASES.items():
+        if any(name in helper.metrics.phases for name in names):
+            timings[phase] = sum(helper.metrics.phases.get(name, 0) for name in names)
+    timings["total"] = total
+    timings["es_requests"] = es.requests - es_requests
+    timings["ytdlp_calls"] = youtube.calls - youtube_calls
+    # The helper's own request counts and latencies, as written to its METRICS_FILE.
+    timings["metrics"] = helper.metrics.to_dict()
+    return timings
+
+
+def main():
+    helper_args = parse_args()
+    es = StandInElasticsearch(args.ES_LATENCY)
+    youtube = StandInYoutube(args.YTDLP_LATENCY)
+    install_stand_ins(es, youtube)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ta_migration_helper as helper
+
+    target = os.path.abspath(args.TARGET_DIR)
+    source_dir = os.path.join(target, "youtube")
+    state_dir = os.path.join(target, "state")
+    # YouTube is paced by the stand-in's latency instead of YTDLP_SLEEP, unless it is given.
+    sys.argv = [helper.__file__, "-d", source_dir, "-s", "0",
+        "--CACHE_FILE", os.path.join(state_dir, "channel_cache.sqlite"),
+        "--SNAPSHOT_FILE", os.path.join(state_dir, "scan_snapshot.json.gz"),
+        "--JOURNAL_FILE", os.path.join(state_dir, "migration_journal.jsonl"),
+        "--COMPARE_FILE", os.path.join(state_dir, "comparison.sqlite"),
+        "--OUTPUT_FILE", os.path.join(state_dir, "report.json")] + ([] if args.ANALYSIS_ONLY else ["-M"]) + helper_args
+    helper.parse_args()
+    # Nobody is there to cancel, and the wait would only be added to every run.
+    helper.MIGRATION_BARRIER = 0
+    print(f"Benchmarking with helper arguments: {' '.join(sys.argv[1:])}")
+
+    results = []
+    for run in range(args.RUNS):
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(state_dir)
+        start = time.perf_counter()
+        file_count = generate_library(source_dir, es, youtube, args.SEED)
+        print(f"Run {run + 1}/{args.RUNS}: generated {file_count} files in {args.CHANNELS} channels ({len(es.docs)} videos in ElasticSearch) in {time.perf_counter() - start:.1f}s.")
+        timings = run_phases(helper, es, youtube, source_dir)
+        timings["files"] = file_count
+        results.append(timings)
+        phases = ", ".join(f"{phase} {timings[phase]:.2f}s" for phase in PHASES if phase in timings)
+        print(f"Run {run + 1}/{args.RUNS}: {phases} | total {timings['total']:.2f}s | {timings['es_requests']} ElasticSearch requests, {timings['ytdlp_calls']} yt-dlp calls.")
+    if not args.KEEP:
+        shutil.rmtree(target, ignore_errors=True)
+
+    if args.OUTPUT_FILE:
+        parameters = {key: value for key, value in vars(args).items() if key not in ["OUTPUT_FILE", "VERBOSE", "KEEP"]}
+        with open(args.OUTPUT_FILE, 'w') as f:
+            json.dump({"parameters": parameters, "helper_args": helper_args, "runs": results}, f, indent=4)
+        print(f"Timings written to `{args.OUTPUT_FILE}`.")
+
+if __name__ == "__main__":
+    main()
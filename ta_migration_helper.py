@@ -1,17 +1,40 @@
 import argparse
+import collections
+import collections.abc
+import contextlib
+import enum
+import errno
+import gzip
+import hashlib
+import itertools
 import json
-import mimetypes
 import os
+import queue
 import re
 import shutil
+import sqlite3
 import stat
 import string
+import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import yt_dlp
 from home.src.es.connect import ElasticWrap, IndexPaginate
 
-rx = '[0-9]{8}_[a-zA-Z0-9_-]{11}_*.*'
+# Legacy filenames look like `YYYYMMDD_<video id>_<title>[.<lang>].<ext>`. A single match
+# pulls out every part; a match that does not start the filename, or is not followed by
+# an underscore, is legacy-looking but has no usable video ID.
+legacy_filename_rx = re.compile(
+    r"(?P<date>[0-9]{8})_(?P<video_id>[a-zA-Z0-9_-]{11})(?P<separator>_?)(?P<title>.*?)"
+    r"(?:(?:\.(?P<lang>[^.]*))?(?P<ext>\.[^.]*))?$",
+    re.DOTALL
+)
+
+ScannedFile = collections.namedtuple('ScannedFile', ['path', 'name', 'size', 'inode', 'mtime'])
+ScannedDirectory = collections.namedtuple('ScannedDirectory', ['path', 'inode', 'mtime', 'files', 'subdirs', 'cached'])
 
 class FakeLogger(object):
     def debug(self, msg):
@@ -134,11 +157,51 @@ iso639_1_to_full_name = {
 
 def parse_args():
     default_source = "/youtube"
+    default_state_dir = '/cache'
     default_use_ytdlp = True
     default_ytdlp_sleep = 3
+    default_ytdlp_burst = 1
+    default_ytdlp_workers = 2
+    default_ytdlp_retries = 3
+    default_ytdlp_probe = False
     default_perform_migration = False
     default_debug = False
+    default_verbose = False
+    default_log_file = None
+    default_progress_interval = 30
     default_dry_run = False
+    default_es_batch_size = 500
+    default_es_slices = 4
+    default_es_bulk_size = 500
+    default_es_bulk_interval = 5
+    default_move_workers = 4
+    default_copy_workers = 2
+    default_copies_per_device = 1
+    default_copy_bandwidth = 0
+    default_prep_workers = 4
+    default_sniff_workers = 4
+    default_scan_workers = 1
+    default_infer_channels = False
+    default_infer_sample = 2
+    default_write_channel_id = False
+    default_pipeline = False
+    default_pipeline_queue = 1000
+    default_metrics_file = None
+    default_prometheus_file = None
+    default_journal_file = None
+    default_resume = False
+    default_discard_journal = False
+    default_write_plan = None
+    default_execute_plan = None
+    default_snapshot_file = None
+    default_full_scan = False
+    default_output_format = 'json'
+    default_output_file = None
+    default_disk_compare = False
+    default_compare_file = None
+    default_cache_file = None
+    default_no_cache = False
+    default_clear_cache = False
     parser = argparse.ArgumentParser(description="TA Migration Helper Script")
     # Optional arguments
     parser.add_argument(
@@ -146,6 +209,11 @@ def parse_args():
         default=default_source,
         help="The source directory that will be searched for videos that need to be migrated."
     )
+    parser.add_argument(
+        '--STATE_DIR',
+        default=default_state_dir,
+        help="Directory the channel ID cache, scan snapshot, migration journal and comparison database are kept in when their paths are not given. Must be outside SOURCE_DIR."
+    )
     parser.add_argument(
         '-Y', '--USE_YTDLP',
         default=default_use_ytdlp,
@@ -154,9 +222,33 @@ def parse_args():
     )
     parser.add_argument(
         '-s', '--YTDLP_SLEEP',
-        type=int,
+        type=float,
         default=default_ytdlp_sleep,
-        help="Number of seconds to wait between each call to YouTube when using yt-dlp. This value is not used if USE_YTDLP is set to False."
+        help="Average number of seconds between each call to YouTube when using yt-dlp, enforced globally across all lookup workers. This value is not used if USE_YTDLP is set to False."
+    )
+    parser.add_argument(
+        '--YTDLP_BURST',
+        type=int,
+        default=default_ytdlp_burst,
+        help="Number of calls to YouTube that may be made back to back before YTDLP_SLEEP pacing applies."
+    )
+    parser.add_argument(
+        '--YTDLP_WORKERS',
+        type=int,
+        default=default_ytdlp_workers,
+        help="Number of concurrent channel ID lookups. Each worker reuses a single yt-dlp instance."
+    )
+    parser.add_argument(
+        '--YTDLP_RETRIES',
+        type=int,
+        default=default_ytdlp_retries,
+        help="Number of times a lookup is retried, with exponential backoff, when YouTube rate limits requests."
+    )
+    parser.add_argument(
+        '--YTDLP_PROBE',
+        default=default_ytdlp_probe,
+        action='store_true',
+        help="If set to True, channel IDs are looked up with the minimum yt-dlp extraction needed to read them, skipping the video page, player JavaScript, formats and manifests. Lookups the probe cannot answer are repeated with a full extraction."
     )
     parser.add_argument(
         '-M', '--PERFORM_MIGRATION',
@@ -170,6 +262,23 @@ def parse_args():
         action='store_true',
         help="If set to True, this will show debugging outputs."
     )
+    parser.add_argument(
+        '-v', '--VERBOSE',
+        default=default_verbose,
+        action='store_true',
+        help="If set to True, a line is printed for every file matched, moved or updated. Otherwise only the progress of each phase, warnings and summaries are printed."
+    )
+    parser.add_argument(
+        '--LOG_FILE',
+        default=default_log_file,
+        help="File every per-file line is written to, with a timestamp, whether or not VERBOSE is set. DRY_RUN lines are written here instead of the standard output."
+    )
+    parser.add_argument(
+        '--PROGRESS_INTERVAL',
+        type=float,
+        default=default_progress_interval,
+        help="Number of seconds between progress summaries when the output is not a terminal. A terminal shows a single status line instead. 0 leaves only the summary at the end of each phase."
+    )
     parser.add_argument(
         '-r', '--DRY_RUN',
         default=default_dry_run,
@@ -182,8 +291,204 @@ def parse_args():
         action='store_true',
         help="If set to True, will attempt to guess the type of the files by looking at the file itself. Decreases chances of false positives based on file extension, but does access the file and can slow down the analysis."
     )
+    parser.add_argument(
+        '--SCAN_WORKERS',
+        type=int,
+        default=default_scan_workers,
+        help="Number of processes the filesystem scan is split across, one top-level directory of SOURCE_DIR at a time."
+    )
+    parser.add_argument(
+        '--SNIFF_WORKERS',
+        type=int,
+        default=default_sniff_workers,
+        help="Number of files read concurrently to determine their type when GUESS_TYPES is set."
+    )
+    parser.add_argument(
+        '--INFER_CHANNELS',
+        default=default_infer_channels,
+        action='store_true',
+        help="If set to True, the channel of a directory without a `channel.id` file is worked out once from a few of its videos and applied to the rest, instead of looking up every video."
+    )
+    parser.add_argument(
+        '--INFER_SAMPLE',
+        type=int,
+        default=default_infer_sample,
+        help="Number of videos looked up per directory when INFER_CHANNELS is set. Their channels must agree for the rest of the directory to use it."
+    )
+    parser.add_argument(
+        '--WRITE_CHANNEL_ID',
+        default=default_write_channel_id,
+        action='store_true',
+        help="If set to True, a `channel.id` file is written to every directory whose channel was inferred, so later runs do not need to look it up."
+    )
+    parser.add_argument(
+        '--ES_SLICES',
+        type=int,
+        default=default_es_slices,
+        help="Number of slices the ElasticSearch video index is split into and read concurrently at the start of the run."
+    )
+    parser.add_argument(
+        '--ES_BATCH_SIZE',
+        type=int,
+        default=default_es_batch_size,
+        help="Number of video IDs requested from ElasticSearch in a single batched lookup."
+    )
+    parser.add_argument(
+        '--ES_BULK_SIZE',
+        type=int,
+        default=default_es_bulk_size,
+        help="Maximum number of videos sent to ElasticSearch in a single bulk update during the migration."
+    )
+    parser.add_argument(
+        '--ES_BULK_INTERVAL',
+        type=float,
+        default=default_es_bulk_interval,
+        help="Maximum number of seconds queued ElasticSearch updates are held before being sent."
+    )
+    parser.add_argument(
+        '--MOVE_WORKERS',
+        type=int,
+        default=default_move_workers,
+        help="Number of concurrent moves within the same filesystem, which are plain renames."
+    )
+    parser.add_argument(
+        '--COPY_WORKERS',
+        type=int,
+        default=default_copy_workers,
+        help="Number of concurrent moves across filesystems, which have to copy the file."
+    )
+    parser.add_argument(
+        '--COPIES_PER_DEVICE',
+        type=int,
+        default=default_copies_per_device,
+        help="Maximum number of concurrent cross-filesystem copies reading from the same device."
+    )
+    parser.add_argument(
+        '--COPY_BANDWIDTH',
+        type=float,
+        default=default_copy_bandwidth,
+        help="Maximum MB/s read by cross-filesystem moves, including their verification, shared across all copies. 0 means unlimited."
+    )
+    parser.add_argument(
+        '--PREP_WORKERS',
+        type=int,
+        default=default_prep_workers,
+        help="Number of channel directories created and permissioned concurrently before the moves start."
+    )
+    parser.add_argument(
+        '--PIPELINE',
+        default=default_pipeline,
+        action='store_true',
+        help="If set to True and PERFORM_MIGRATION is True, videos found in both ElasticSearch and the filesystem are migrated while the scan is still running. Every other video is migrated after the comparison."
+    )
+    parser.add_argument(
+        '--PIPELINE_QUEUE',
+        type=int,
+        default=default_pipeline_queue,
+        help="Maximum number of videos waiting to be migrated in pipelined mode before the scan waits for the moves to catch up."
+    )
+    parser.add_argument(
+        '--JOURNAL_FILE',
+        default=default_journal_file,
+        help="Path of the migration journal used to resume an interrupted migration. Defaults to a file in STATE_DIR."
+    )
+    parser.add_argument(
+        '--RESUME',
+        default=default_resume,
+        action='store_true',
+        help="If set to True, finishes the moves and ElasticSearch updates left outstanding in the migration journal without rescanning the filesystem."
+    )
+    parser.add_argument(
+        '--DISCARD_JOURNAL',
+        default=default_discard_journal,
+        action='store_true',
+        help="If set to True, starts a new migration even though the migration journal still has outstanding moves or ElasticSearch updates from an earlier run."
+    )
+    parser.add_argument(
+        '--WRITE_PLAN',
+        default=default_write_plan,
+        help="Path the planned migration is written to once the comparison is complete, so it can be run later with EXECUTE_PLAN. Works with or without PERFORM_MIGRATION."
+    )
+    parser.add_argument(
+        '--EXECUTE_PLAN',
+        default=default_execute_plan,
+        help="Path of a plan written by WRITE_PLAN to migrate directly, without scanning the filesystem or comparing it to ElasticSearch. Files changed since the plan was written are skipped. Can be combined with DRY_RUN."
+    )
+    parser.add_argument(
+        '--OUTPUT_FORMAT',
+        default=default_output_format,
+        choices=['json', 'ndjson'],
+        help="Format of the comparison results. `json` prints a single document at the end of the comparison, `ndjson` streams one record per video as soon as it is classified and requires OUTPUT_FILE."
+    )
+    parser.add_argument(
+        '--OUTPUT_FILE',
+        default=default_output_file,
+        help="File the comparison results are written to instead of the standard output."
+    )
+    parser.add_argument(
+        '--DISK_COMPARE',
+        default=default_disk_compare,
+        action='store_true',
+        help="If set to True, the videos loaded from ElasticSearch, the files found by the scan and the comparison results are kept in a SQLite database instead of memory, and compared by merging them in video ID order. Keeps memory use flat on very large libraries."
+    )
+    parser.add_argument(
+        '--COMPARE_FILE',
+        default=default_compare_file,
+        help="Path of the SQLite database used by DISK_COMPARE. It is recreated on every run. Defaults to a file in STATE_DIR."
+    )
+    parser.add_argument(
+        '--SNAPSHOT_FILE',
+        default=default_snapshot_file,
+        help="Path of the scan snapshot used to skip unchanged directories on the next run. Defaults to a file in STATE_DIR."
+    )
+    parser.add_argument(
+        '--FULL_SCAN',
+        default=default_full_scan,
+        action='store_true',
+        help="If set to True, every directory is scanned again instead of reusing unchanged directories from the scan snapshot."
+    )
+    parser.add_argument(
+        '--CACHE_FILE',
+        default=default_cache_file,
+        help="Path of the persistent channel ID cache. Defaults to a file in STATE_DIR."
+    )
+    parser.add_argument(
+        '--NO_CACHE',
+        default=default_no_cache,
+        action='store_true',
+        help="If set to True, the channel ID cache will not be read or updated."
+    )
+    parser.add_argument(
+        '--CLEAR_CACHE',
+        default=default_clear_cache,
+        action='store_true',
+        help="If set to True, all entries in the channel ID cache are removed before resolving channels again."
+    )
+    parser.add_argument(
+        '--METRICS_FILE',
+        default=default_metrics_file,
+        help="Path the JSON summary of phase timings, request counts and latencies is written to at the end of the run. Not written unless set."
+    )
+    parser.add_argument(
+        '--PROMETHEUS_FILE',
+        default=default_prometheus_file,
+        help="Path of a Prometheus textfile-collector file the same metrics are written to, e.g. `/var/lib/node_exporter/ta_migration.prom`."
+    )
     global args
     args = parser.parse_args()
+    if args.OUTPUT_FORMAT == 'ndjson' and not args.OUTPUT_FILE:
+        # The status messages are printed to the standard output as well and would be mixed into the records.
+        parser.error("--OUTPUT_FORMAT ndjson requires --OUTPUT_FILE.")
+    if not all([args.CACHE_FILE, args.SNAPSHOT_FILE, args.JOURNAL_FILE, args.COMPARE_FILE]) and not os.path.isdir(args.STATE_DIR):
+        parser.error(f"The state directory `{args.STATE_DIR}` does not exist. Set --STATE_DIR to a directory outside SOURCE_DIR.")
+    if not args.CACHE_FILE:
+        args.CACHE_FILE = state_file_path(args.STATE_DIR, args.SOURCE_DIR, "channel_cache.sqlite")
+    if not args.SNAPSHOT_FILE:
+        args.SNAPSHOT_FILE = state_file_path(args.STATE_DIR, args.SOURCE_DIR, "scan_snapshot.json.gz")
+    if not args.JOURNAL_FILE:
+        args.JOURNAL_FILE = state_file_path(args.STATE_DIR, args.SOURCE_DIR, "migration_journal.jsonl")
+    if not args.COMPARE_FILE:
+        args.COMPARE_FILE = state_file_path(args.STATE_DIR, args.SOURCE_DIR, "comparison.sqlite")
     if args.DEBUG:
         dprint("Arguments provided:")
         for arg in vars(args):
@@ -194,85 +499,673 @@ def dprint(value, **kwargs):
     if args.DEBUG:
         print(f"DEBUG:\t{value}", **kwargs)
 
-# Function to extract video IDs from filenames
-def extract_video_id(filename):
-    match = re.match(r"(\d{8})_([a-zA-Z0-9_-]{11})_", filename)
-    if match:
-        return match.group(2)
-    return None
+class Metrics(object):
+    """Phase timings, counters and latency histograms collected over a run.
+
+    Written at the end of the run as a JSON summary and, optionally, as a Prometheus
+    textfile-collector file, so a long run shows where its time went.
+    """
+    PREFIX = "ta_migration"
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    # Name of the label each labelled metric is split by.
+    LABELS = {
+        "es_requests": "endpoint",
+        "es_errors": "endpoint",
+        "es_request_seconds": "endpoint",
+        "files_moved": "method",
+        "bytes_moved": "method",
+        "move_seconds": "method",
+        "sleep_seconds": "reason",
+        "ytdlp_calls": "mode",
+        "ytdlp_failures": "mode",
+        "ytdlp_request_seconds": "mode",
+        "ytdlp_http_requests": "mode",
+        "ytdlp_bytes": "mode",
+    }
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - started
+
+    def add(self, name, value=1, label=None):
+        with self.lock:
+            self.counters[(name, label)] += value
+
+    def observe(self, name, seconds, label=None):
+        with self.lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[(name, label)] = {"buckets": [0] * len(self.LATENCY_BUCKETS), "count": 0, "sum": 0}
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+
+    def total(self, name):
+        """Sum of a counter over all of its labels."""
+        with self.lock:
+            return sum(value for (counter, _), value in self.counters.items() if counter == name)
+
+    @contextlib.contextmanager
+    def timer(self, name, label=None):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, label)
+
+    @staticmethod
+    def _sorted(items):
+        return sorted(items, key=lambda item: (item[0][0], item[0][1] or ''))
+
+    def to_dict(self):
+        def put(target, name, label, value):
+            if label is None:
+                target[name] = value
+            else:
+                target.setdefault(name, {})[label] = value
+        with self.lock:
+            summary = {"phases": {name: round(seconds, 3) for name, seconds in self.phases.items()}, "counters": {}, "histograms": {}}
+            for (name, label), value in self._sorted(self.counters.items()):
+                put(summary["counters"], name, label, round(value, 3) if isinstance(value, float) else value)
+            for (name, label), histogram in self._sorted(self.histograms.items()):
+                buckets = {str(bound): count for bound, count in zip(self.LATENCY_BUCKETS, histogram["buckets"])}
+                buckets["+Inf"] = histogram["count"]
+                put(summary["histograms"], name, label, {"count": histogram["count"], "sum": round(histogram["sum"], 3), "buckets": buckets})
+        return summary
+
+    def _series(self, name, suffix, label, le=None):
+        labels = []
+        if label is not None:
+            labels.append(f'{self.LABELS.get(name, "label")}="{label}"')
+        if le is not None:
+            labels.append(f'le="{le}"')
+        return f"{self.PREFIX}_{name}{suffix}" + ("{" + ",".join(labels) + "}" if labels else "")
+
+    def to_prometheus(self):
+        lines = [f"# TYPE {self.PREFIX}_phase_seconds gauge"]
+        with self.lock:
+            for name, seconds in sorted(self.phases.items()):
+                lines.append(f'{self.PREFIX}_phase_seconds{{phase="{name}"}} {seconds:.6f}')
+            typed = set()
+            for (name, label), value in self._sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {self.PREFIX}_{name}_total counter")
+                lines.append(f"{self._series(name, '_total', label)} {value}")
+            for (name, label), histogram in self._sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {self.PREFIX}_{name} histogram")
+                for bound, count in zip(self.LATENCY_BUCKETS, histogram["buckets"]):
+                    lines.append(f"{self._series(name, '_bucket', label, bound)} {count}")
+                lines.append(f"{self._series(name, '_bucket', label, '+Inf')} {histogram['count']}")
+                lines.append(f"{self._series(name, '_sum', label)} {histogram['sum']:.6f}")
+                lines.append(f"{self._series(name, '_count', label)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
 
-# Function to get channel ID using yt-dlp
-def get_channel_id(video_id):
-    if args.USE_YTDLP:
-        ydl_opts = {'quiet': True, 'logger': FakeLogger()}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    def write(self, json_path, prometheus_path=None):
+        # Written to a temporary file first so readers never see a partial file.
+        for path, content in [(json_path, json.dumps(self.to_dict(), indent=4)), (prometheus_path, None)]:
+            if not path:
+                continue
+            if content is None:
+                content = self.to_prometheus()
+            try:
+                with open(f"{path}.tmp", 'w') as f:
+                    f.write(content)
+                os.replace(f"{path}.tmp", path)
+            except OSError as e:
+                print(f"Unable to write metrics to `{path}`: {e}")
+
+    def summary(self):
+        phases = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.phases.items())
+        return f"Phase timings: {phases or 'none'}."
+
+metrics = Metrics()
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class StatusLineStream(object):
+    """Standard output that clears the progress status line before anything is written over it."""
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+
+    def write(self, text):
+        with self.progress.lock:
+            self.progress.clear_line()
+            return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Progress(object):
+    """Progress of the current phase, shown at a bounded rate instead of a line per item.
+
+    On a terminal a single status line is redrawn a few times a second. Otherwise a
+    summary line is printed every PROGRESS_INTERVAL seconds. Either way, every phase
+    ends with one summary line. Per-item lines go through `item`, which only prints
+    them when VERBOSE is set and writes them to LOG_FILE if there is one.
+    """
+    REFRESH = 0.25
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.enabled = False
+        self.tty = False
+        self.interval = 0
+        self.verbose = False
+        self.log = None
+        # Returns the number of channel lookups waiting on yt-dlp, while a resolver is running.
+        self.queue_depth = None
+        self.line_active = False
+        self.phase = None
+
+    def configure(self, interval, verbose, log_path=None):
+        self.enabled = True
+        self.interval = interval
+        self.verbose = verbose
+        self.tty = sys.stderr.isatty()
+        if self.tty and sys.stdout.isatty():
+            sys.stdout = StatusLineStream(sys.stdout, self)
+        if log_path:
             try:
-                time.sleep(args.YTDLP_SLEEP)
-                info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+                self.log = open(log_path, 'a')
+            except OSError as e:
+                print(f"Unable to open the log file `{log_path}`. Per-file lines will not be logged: {e}")
+
+    def start(self, phase, unit, total=None):
+        with self.lock:
+            self.phase = phase
+            self.unit = unit
+            self.total = total
+            self.done = 0
+            self.started = time.monotonic()
+            self.es_requests = metrics.total("es_requests")
+            self.next_render = self.started + (self.REFRESH if self.tty else self.interval)
+
+    def advance(self, count=1):
+        with self.lock:
+            if self.phase is None:
+                return
+            self.done += count
+            now = time.monotonic()
+            if self.enabled and now >= self.next_render and (self.tty or self.interval > 0):
+                self.next_render = now + (self.REFRESH if self.tty else self.interval)
+                self.render(now)
+
+    def status(self, now):
+        elapsed = max(now - self.started, 1e-9)
+        rate = self.done / elapsed
+        if self.total:
+            parts = [f"{self.phase}: {self.done:,}/{self.total:,} {self.unit} ({min(100, 100 * self.done // self.total)}%)"]
+        else:
+            parts = [f"{self.phase}: {self.done:,} {self.unit}"]
+        parts.append(f"{rate:,.1f} {self.unit}/s")
+        parts.append(f"ElasticSearch {(metrics.total('es_requests') - self.es_requests) / elapsed:,.1f} requests/s")
+        if self.queue_depth:
+            parts.append(f"yt-dlp queue {self.queue_depth()}")
+        if self.total and self.done < self.total and rate > 0:
+            parts.append(f"ETA {format_duration((self.total - self.done) / rate)}")
+        return " | ".join(parts)
+
+    def render(self, now):
+        line = self.status(now)
+        if self.tty:
+            width = shutil.get_terminal_size().columns - 1
+            sys.stderr.write(f"\r{line[:width]}\033[K")
+            sys.stderr.flush()
+            self.line_active = True
+        else:
+            print(line)
+        if self.log:
+            self.log.flush()
+
+    def clear_line(self):
+        if self.line_active:
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+            self.line_active = False
+
+    def finish(self):
+        with self.lock:
+            if self.phase is None:
+                return
+            elapsed = time.monotonic() - self.started
+            phase = self.phase
+            self.phase = None
+            self.clear_line()
+            if self.enabled:
+                print(f"{phase}: {self.done:,} {self.unit} in {format_duration(elapsed)} ({self.done / max(elapsed, 1e-9):,.1f} {self.unit}/s).")
+
+    def item(self, line, required=False):
+        """Logs a per-item line. `required` lines, such as DRY_RUN output, are printed when there is no log file to hold them."""
+        with self.lock:
+            if self.log:
+                self.log.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {line}\n")
+            if self.verbose or not self.enabled or required and not self.log:
+                print(line)
+
+    def close(self):
+        self.finish()
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+            if isinstance(sys.stdout, StatusLineStream):
+                sys.stdout = sys.stdout.stream
+
+progress = Progress()
+
+def vprint(value, required=False):
+    progress.item(value, required)
+
+def es_request(method, path, **kwargs):
+    """Sends a request through `ElasticWrap`, recording it by endpoint (e.g. `_mget`, `_bulk`)."""
+    endpoint = path.split('?')[0].rsplit('/', 1)[-1]
+    metrics.add("es_requests", label=endpoint)
+    with metrics.timer("es_request_seconds", endpoint):
+        res = getattr(ElasticWrap(path), method)(**kwargs)
+    if res[1] != 200:
+        metrics.add("es_errors", label=endpoint)
+    return res
+
+class TokenBucket(object):
+    """Thread-safe token bucket used to enforce a global request rate."""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Holds back every caller, not just the one that hit the limit.
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` are available. Returns the number of seconds spent waiting."""
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    if self.rate <= 0:
+                        return waited
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return waited
+                    delay = (tokens - self.tokens) / self.rate
+                else:
+                    self.updated = self.paused_until
+                    delay = self.paused_until - now
+            time.sleep(delay)
+            waited += delay
+
+
+class ChannelResolver(object):
+    """Resolves channel IDs for video IDs on a small pool of workers.
+
+    Each worker keeps its own long-lived `YoutubeDL` instance, and every call to
+    YouTube draws from a shared token bucket instead of sleeping unconditionally.
+    Lookups are returned as futures so the filesystem walk can continue while they
+    are in flight.
+
+    In probe mode, yt-dlp only fetches the player response the channel ID is read
+    from, and the result is returned unprocessed. A lookup the probe cannot answer
+    is repeated with a full extraction.
+    """
+    PROBE_OPTS = {
+        'skip_download': True,
+        'noplaylist': True,
+        'check_formats': False,
+        'extractor_args': {'youtube': {
+            'player_skip': ['webpage', 'configs', 'js', 'initial_data'],
+            'skip': ['dash', 'hls', 'translated_subs'],
+        }},
+    }
+
+    def __init__(self, use_ytdlp=True, sleep=3, burst=1, workers=2, retries=3, es_fallback=True, probe=False):
+        self.use_ytdlp = use_ytdlp
+        self.es_fallback = es_fallback
+        self.sleep = sleep
+        self.retries = retries
+        self.probe = probe
+        self.bucket = TokenBucket(1 / sleep if sleep > 0 else 0, burst)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ytdlp")
+        self.local = threading.local()
+        self.instances = contextlib.ExitStack()
+        self.instances_lock = threading.Lock()
+        self.futures = {}
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+
+    def _get_ydl(self, mode):
+        if not hasattr(self.local, 'ydls'):
+            self.local.ydls = {}
+        ydl = self.local.ydls.get(mode)
+        if ydl is None:
+            ydl_opts = {'quiet': True, 'logger': FakeLogger()}
+            if mode == "probe":
+                ydl_opts.update(self.PROBE_OPTS)
+            with self.instances_lock:
+                ydl = self.instances.enter_context(yt_dlp.YoutubeDL(ydl_opts))
+            self._count_traffic(ydl, mode)
+            self.local.ydls[mode] = ydl
+        return ydl
+
+    def _count_traffic(self, ydl, mode):
+        # Every HTTP request yt-dlp makes, and every byte read from it, is counted for the current lookup and the run.
+        urlopen = ydl.urlopen
+
+        def counted_urlopen(req):
+            metrics.add("ytdlp_http_requests", label=mode)
+            self.local.requests += 1
+            res = urlopen(req)
+            read = res.read
+
+            def counted_read(*args, **kwargs):
+                data = read(*args, **kwargs)
+                metrics.add("ytdlp_bytes", len(data), mode)
+                self.local.bytes += len(data)
+                return data
+            res.read = counted_read
+            return res
+        ydl.urlopen = counted_urlopen
+
+    def _extract(self, video_id, mode):
+        ydl = self._get_ydl(mode)
+        self.local.requests = 0
+        self.local.bytes = 0
+        metrics.add("sleep_seconds", self.bucket.acquire(), "ytdlp_rate_limit")
+        metrics.add("ytdlp_calls", label=mode)
+        started = time.monotonic()
+        try:
+            with metrics.timer("ytdlp_request_seconds", mode):
+                return ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False, process=mode != "probe")
+        finally:
+            dprint(f"yt-dlp {mode} lookup of {video_id}: {self.local.requests} requests, {self.local.bytes} bytes in {time.monotonic() - started:.2f}s.")
+
+    def submit(self, video_id):
+        """Queues a lookup for `video_id`. Repeated requests share the same future."""
+        future = self.futures.get(video_id)
+        if future is None:
+            with self.queued_lock:
+                self.queued += 1
+            future = self.executor.submit(self.resolve, video_id)
+            future.add_done_callback(self._lookup_done)
+            self.futures[video_id] = future
+        return future
+
+    def _lookup_done(self, future):
+        with self.queued_lock:
+            self.queued -= 1
+
+    def queue_depth(self):
+        """Number of lookups submitted that have not finished yet."""
+        return self.queued
+
+    def resolve(self, video_id):
+        if not self.use_ytdlp:
+            if not self.es_fallback:
+                print(f"Failed to find video ID from YouTube or ElasticSearch for {video_id}. USE_YTDLP set to False and the video is not in ElasticSearch.")
+                return None
+            try:
+                es_channel_id = check_channel_id_from_es(video_id)
+                if es_channel_id:
+                    return es_channel_id
+                return None
+            except:
+                e = "USE_YTDLP set to False. YouTube Download Error does not exist."
+                print(f"Failed to find video ID from YouTube or ElasticSearch for {video_id}. YouTube download error: {e}")
+                return None
+        mode = "probe" if self.probe else "full"
+        attempt = 0
+        while True:
+            try:
+                info = self._extract(video_id, mode)
+                if not info.get('channel_id') and mode == "probe":
+                    dprint(f"The yt-dlp probe returned no channel ID for {video_id}. Retrying with a full extraction.")
+                    metrics.add("ytdlp_probe_fallbacks")
+                    mode = "full"
+                    continue
                 dprint(f"Channel extracted from YTDL: {info.get('channel_id')}")
                 return info.get('channel_id')
             except yt_dlp.utils.DownloadError as e:
+                metrics.add("ytdlp_failures", label=mode)
+                if mode == "probe" and not is_rate_limited(e) and not is_unavailable(e):
+                    dprint(f"The yt-dlp probe failed for {video_id}. Retrying with a full extraction: {e}")
+                    metrics.add("ytdlp_probe_fallbacks")
+                    mode = "full"
+                    continue
+                if is_rate_limited(e) and attempt < self.retries:
+                    backoff = max(self.sleep, 1) * 2 ** (attempt + 1)
+                    attempt += 1
+                    print(f"YouTube is rate limiting requests. Backing off for {backoff} seconds before retrying {video_id} [{attempt}/{self.retries}].")
+                    self.bucket.pause(backoff)
+                    continue
+                if not self.es_fallback:
+                    print(f"Failed to find video ID from YouTube or ElasticSearch for {video_id}. YouTube download error: {e}")
+                    return None
                 try:
                     return check_channel_id_from_es(video_id)
                 except:
                     print(f"Failed to find video ID from YouTube or ElasticSearch for {video_id}. YouTube download error: {e}")
                     return None
-    else:
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.instances.close()
+
+
+class ChannelCache(object):
+    """Persistent video ID to channel ID cache, shared across runs.
+
+    Channel IDs never change for a video, so every successful resolution is kept in
+    a small SQLite database and consulted before calling yt-dlp or ElasticSearch.
+    """
+    COMMIT_INTERVAL = 500
+
+    def __init__(self, path, enabled=True, clear=False):
+        self.path = path
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.uncommitted = 0
+        self.conn = None
+        if not enabled:
+            return
         try:
-            es_channel_id = check_channel_id_from_es(video_id)
-            if es_channel_id:
-                return es_channel_id
-            return None 
-        except:
-            e = "USE_YTDLP set to False. YouTube Download Error does not exist."
-            print(f"Failed to find video ID from YouTube or ElasticSearch for {video_id}. YouTube download error: {e}")
+            self.conn = sqlite3.connect(path)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS channel_ids (video_id TEXT PRIMARY KEY, channel_id TEXT NOT NULL, source TEXT, updated REAL)")
+            if clear:
+                print(f"Clearing channel ID cache at `{path}`.")
+                self.conn.execute("DELETE FROM channel_ids")
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Unable to open the channel ID cache at `{path}`. Continuing without it: {e}")
+            self.enabled = False
+            self.conn = None
+
+    def get(self, video_id):
+        if not self.enabled:
             return None
+        row = self.conn.execute("SELECT channel_id FROM channel_ids WHERE video_id = ?", (video_id,)).fetchone()
+        if row:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, video_id, channel_id, source):
+        if not self.enabled or not channel_id:
+            return
+        self.conn.execute("INSERT OR REPLACE INTO channel_ids VALUES (?, ?, ?, ?)", (video_id, channel_id, source, time.time()))
+        self.stored += 1
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        if self.conn:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def summary(self):
+        if not self.enabled:
+            return "Channel ID cache disabled."
+        return f"Channel ID cache `{self.path}`: {self.hits} hits, {self.misses} misses, {self.stored} entries stored."
+
+
+def state_file_path(state_dir, source_dir, name):
+    # Named after SOURCE_DIR so runs against different directories keep separate state.
+    source_dir = os.path.abspath(source_dir)
+    return os.path.join(state_dir, f"ta_migration_{os.path.basename(source_dir) or 'root'}_{name}")
+
+def is_rate_limited(error):
+    message = str(error)
+    return "429" in message or "Too Many Requests" in message
 
+def is_unavailable(error):
+    # A full extraction would fail the same way, so a failed probe is not repeated.
+    message = str(error)
+    return any(reason in message for reason in ("Video unavailable", "Private video", "This video has been removed", "This video is no longer available"))
+
+# Fields of `ta_video` documents needed by the helper. Everything else is left in ElasticSearch.
+ES_VIDEO_SOURCE_FIELDS = ["youtube_id", "media_url", "subtitles", "channel.channel_id"]
+
+ES_PIT_KEEP_ALIVE = "5m"
+ES_PAGE_SIZE = 1000
+
+def add_video_hit(video_ids, hit):
+    video = {"media_url": hit['media_url'], "channel_id": hit.get('channel', {}).get('channel_id')}
+    if hit.get('subtitles'):
+        # Kept as stored in ElasticSearch so migrated subtitles can be merged into them.
+        video['subtitles'] = hit['subtitles']
+    video_ids[hit['youtube_id']] = video
+
+def load_video_slice(video_ids, pit_id, slice_id, slices):
+    """Pages through one slice of a point in time of `ta_video`, adding each hit to `video_ids` as it arrives."""
+    data = {
+        "size": ES_PAGE_SIZE,
+        "_source": ES_VIDEO_SOURCE_FIELDS,
+        "pit": {"id": pit_id, "keep_alive": ES_PIT_KEEP_ALIVE},
+        "sort": ["_shard_doc"],
+    }
+    if slices > 1:
+        data["slice"] = {"id": slice_id, "max": slices}
+    loaded = 0
+    while True:
+        res = es_request("post", "_search", data=data)
+        if res[1] != 200:
+            raise RuntimeError(f"Status {res[1]}: {res[0]}")
+        hits = res[0]['hits']['hits']
+        for hit in hits:
+            add_video_hit(video_ids, hit['_source'])
+        loaded += len(hits)
+        progress.advance(len(hits))
+        if len(hits) < ES_PAGE_SIZE:
+            return loaded
+        data["pit"]["id"] = res[0].get('pit_id', data["pit"]["id"])
+        data["search_after"] = hits[-1]['sort']
 
 # Function to retrieve video IDs from Elasticsearch
-def get_video_ids_from_es():
+def get_video_ids_from_es(store=None):
+    """Loads the fields of every `ta_video` document needed by the helper.
+
+    The index is read from a point in time, split into ES_SLICES slices that are paged
+    through concurrently. If a point in time cannot be used, it falls back to
+    `IndexPaginate`. With a comparison store, the videos are written to it as they
+    arrive instead of being held in memory.
+    """
     print("Pulling video IDs from ElasticSearch...")
-    res = IndexPaginate('ta_video',{}).get_results()
-    video_ids = {}
-    for hit in res:
-        video_ids[hit['youtube_id']] = {"media_url": hit['media_url']}
-        if hit.get('subtitles'):
-            video_ids[hit['youtube_id']]['subtitles'] = []
-            for sub in hit['subtitles']:
-                video_ids[hit['youtube_id']]['subtitles'].append({sub['lang']: sub['media_url']})
+    progress.start("Loading ElasticSearch", "videos")
+    video_ids = StoredVideos(store) if store else {}
+    loaded = False
+    res = es_request("post", f"ta_video/_pit?keep_alive={ES_PIT_KEEP_ALIVE}")
+    if res[1] == 200 and res[0].get('id'):
+        pit_id = res[0]['id']
+        slices = max(1, args.ES_SLICES)
+        try:
+            with ThreadPoolExecutor(max_workers=slices, thread_name_prefix="es-slice") as executor:
+                futures = [executor.submit(load_video_slice, video_ids, pit_id, i, slices) for i in range(slices)]
+                for future in futures:
+                    future.result()
+            loaded = True
+        except Exception as e:
+            print(f"Unable to read ElasticSearch in {slices} slices. Falling back to a single pass: {e}")
+        finally:
+            es_request("delete", "_pit", data={"id": pit_id})
+    else:
+        print(f"Unable to open a point in time on ElasticSearch. Falling back to a single pass. Status {res[1]}: {res[0]}")
+    if not loaded:
+        video_ids.clear()
+        metrics.add("es_requests", label="paginate")
+        with metrics.timer("es_request_seconds", "paginate"):
+            res = IndexPaginate('ta_video', {"_source": ES_VIDEO_SOURCE_FIELDS}).get_results()
+        for hit in res:
+            add_video_hit(video_ids, hit)
+        progress.advance(len(res))
+    progress.finish()
+    print(f"Loaded {len(video_ids)} videos from ElasticSearch.")
     return video_ids
 
-def check_video_id_from_es(video_id):
-    res = ElasticWrap("ta_video/_search").get(data={"query": {"match":{"_id": video_id}}})
-    if res[1] == 200:
-        res = res[0]
-    video_ids = {}
-    for hit in res['hits']['hits']:
-        video_ids[hit['_id']] = {"media_url": hit['_source']['media_url']}
-        if hit['_source'].get('subtitles'):
-            video_ids[hit['_id']]['subtitles'] = []
-            for sub in hit['_source']['subtitles']:
-                video_ids[hit['_id']]['subtitles'].append({sub['lang']: sub['media_url']})
-    return video_ids
+def get_videos_from_es(video_ids, chunk_size):
+    """Fetches `ta_video` documents for many IDs with one `_mget` request per chunk of IDs."""
+    video_ids = list(video_ids)
+    docs = {}
+    source_fields = ','.join(ES_VIDEO_SOURCE_FIELDS)
+    for i in range(0, len(video_ids), chunk_size):
+        chunk = video_ids[i:i + chunk_size]
+        dprint(f"Requesting {len(chunk)} videos from ElasticSearch.")
+        res = es_request("get", f"ta_video/_mget?_source_includes={source_fields}", data={"ids": chunk})
+        if res[1] != 200:
+            print(f"ElasticSearch lookup of {len(chunk)} videos failed with status {res[1]}: {res[0]}")
+            continue
+        for doc in res[0].get('docs', []):
+            if doc.get('found'):
+                docs[doc['_id']] = doc['_source']
+    return docs
 
-def pull_video_from_es(video_id):
-    res = ElasticWrap("ta_video/_search").get(data={"query": {"match":{"_id": video_id}}})
-    if res[1] == 200:
-        res = res[0]
-    video_ids = {}
-    for hit in res['hits']['hits']:
-        video_ids[hit['_id']] = {}
-        video_ids[hit['_id']]['channel_id'] = hit['_source']['channel']['channel_id']
-        video_ids[hit['_id']]['media_url'] = hit['_source']['media_url']
-        if hit['_source'].get('subtitles'):
-            video_ids[hit['_id']]['subs'] = []
-            for sub in hit['_source']['subtitles']:
-                video_ids[hit['_id']]['subs'].append({sub['lang']: sub['media_url']})
-    return video_ids
-        
+def check_video_ids_from_es(video_ids, chunk_size):
+    found = {}
+    for vid_id, source in get_videos_from_es(video_ids, chunk_size).items():
+        found[vid_id] = {"media_url": source['media_url']}
+        if source.get('subtitles'):
+            found[vid_id]['subtitles'] = []
+            for sub in source['subtitles']:
+                found[vid_id]['subtitles'].append({sub['lang']: sub['media_url']})
+    return found
 
 def check_channel_id_from_es(video_id):
-    res = ElasticWrap("ta_video/_search").get(data={"query": {"match":{"_id": video_id}}})
+    res = es_request("get", "ta_video/_search", data={"query": {"match":{"_id": video_id}}})
     if res[1] == 200:
         res = res[0]
     channel_id = None
@@ -280,143 +1173,962 @@ def check_channel_id_from_es(video_id):
         channel_id = hit['_source']['channel']['channel_id']
     return channel_id
 
-def check_filesystem_for_video_ids(video_list, video_ids):
+# Every window of a path that could hold a YouTube video ID, including overlapping ones.
+video_id_window_rx = re.compile(r"(?=([a-zA-Z0-9_-]{11}))")
+
+class FileIndex(object):
+    """All files seen during the filesystem review, indexed by the video IDs they contain.
+
+    Video IDs have a fixed length and alphabet, so a path only has to be checked once
+    against the set of IDs of interest by looking up each candidate window. Lookups for
+    those IDs are then served from the index instead of rescanning every path. Paths
+    are kept relative to `root` and returned as full paths.
+    """
+    def __init__(self, root, video_ids=()):
+        self.root = root.rstrip('/') + '/'
+        self.paths = []
+        self.patterns = set(video_ids)
+        self.by_video_id = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return (self.root + path for path in self.paths)
+
+    def add(self, path):
+        # The shared SOURCE_DIR prefix is left out so it is not repeated for every file
+        # and cannot match every file.
+        relative = path[len(self.root):] if path.startswith(self.root) else path
+        self.paths.append(relative)
+        if self.patterns:
+            for video_id in self.patterns.intersection(video_id_window_rx.findall(relative)):
+                self.by_video_id.setdefault(video_id, []).append(relative)
+        return relative
+
+    def find(self, video_ids):
+        found = []
+        for video_id in video_ids:
+            if video_id in self.patterns:
+                found.extend(self.root + path for path in self.by_video_id.get(video_id, []))
+            else:
+                found.extend(path for path in self if video_id in path)
+        return found
+
+
+def check_filesystem_for_video_ids(file_index, video_ids):
     dprint(f"Scanning through previously iterated filesystem list for the following video(s): {video_ids}")
-    final_list = [nm for ps in video_ids for nm in video_list if ps in nm]
-    return final_list
+    return file_index.find(video_ids)
+
+
+def read_channel_id_file(root):
+    channel_id = None
+    with open(os.path.join(root,"channel.id"), 'r') as channel_file:
+        for line in channel_file.readlines():
+            if len(line) > 0:
+                channel_id = line.strip()
+    return channel_id
+
+class ContentSniffer(object):
+    """Classifies files by the first bytes of their content when GUESS_TYPES is set.
+
+    Only a small prefix of each file is read, in binary. Reads are spread over a
+    thread pool so slow disks overlap, and results are kept per (inode, size, mtime)
+    so a file classified during the scan is not opened again by the migration.
+    """
+    PREFIX_SIZE = 512
+    EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+    UTF8_BOM = b'\xef\xbb\xbf'
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sniff")
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def submit(self, path, inode, size, mtime):
+        key = (inode, size, mtime)
+        with self.lock:
+            future = self.results.get(key)
+            if future is None:
+                future = self.executor.submit(self.sniff, path)
+                self.results[key] = future
+        return future
+
+    def classify(self, path):
+        try:
+            path_stat = os.stat(path)
+        except OSError as e:
+            print(f"An error occurred while attempting to determine filetype for {path}: {e}")
+            future = Future()
+            future.set_result((FileType.OTHER, None))
+            return future
+        return self.submit(path, path_stat.st_ino, path_stat.st_size, path_stat.st_mtime)
+
+    def sniff(self, path):
+        try:
+            with open(path, 'rb') as f:
+                prefix = f.read(self.PREFIX_SIZE)
+        except OSError as e:
+            print(f"An error occurred while attempting to determine filetype for {path}: {e}")
+            return FileType.OTHER, None
+        dprint(f"File prefix of `{path}`: {prefix[:16]}")
+        if prefix[4:8] == b'ftyp' or prefix.startswith(self.EBML_MAGIC):
+            return FileType.VIDEO, None
+        if prefix.startswith(self.UTF8_BOM):
+            prefix = prefix[len(self.UTF8_BOM):]
+        if prefix.startswith(b'WEBVTT'):
+            lang = None
+            # The header ends at the first blank line.
+            for line in prefix.split(b'\n\n', 1)[0].splitlines()[1:]:
+                if line.startswith(b'Language:'):
+                    lang = line[len(b'Language:'):].strip().decode('utf-8', 'replace').lower() or None
+                    break
+            return FileType.SUBTITLE, lang
+        return FileType.OTHER, None
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def type_from_extension(path):
+    name, ext = os.path.splitext(path)
+    if ext in ['.mp4']:
+        return FileType.VIDEO, None
+    elif ext in ['.vtt']:
+        # Stripped the same way as the language of a scanned subtitle, so both compare equal.
+        return FileType.SUBTITLE, os.path.splitext(name)[-1].translate(str.maketrans('', '', string.punctuation)) or None
+    return FileType.OTHER, None
+
+def write_channel_id_file(root, channel_id):
+    path = os.path.join(root, "channel.id")
+    if args.DRY_RUN:
+        print(f"DRY_RUN:\tWriting channel ID {channel_id} to `{path}`.")
+        return
+    try:
+        with open(path, 'x') as channel_file:
+            channel_file.write(f"{channel_id}\n")
+        print(f"Wrote channel ID {channel_id} to `{path}`.")
+    except OSError as e:
+        print(f"Unable to write the channel ID to `{path}`: {e}")
+
+def build_file_record(dir, root, filename, video_id, channel_id, ext, name_lang, sniffed=None):
+    original_location = os.path.join(root, filename)
+    expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}{ext}")
+    lang = None
+    if sniffed is not None:
+        vid_type, lang = sniffed.result()
+        if vid_type == FileType.SUBTITLE and lang:
+            expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}.{lang}{ext}")
+    else:
+        if ext in ['.mp4']:
+            vid_type = FileType.VIDEO
+        elif ext in ['.vtt']:
+            vid_type = FileType.SUBTITLE
+            lang = name_lang.translate(str.maketrans('', '', string.punctuation))
+            expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}.{lang}{ext}")
+        else:
+            vid_type = FileType.OTHER
+    dprint(f"File is of type: {vid_type.value}")
+    if vid_type == FileType.SUBTITLE:
+        dprint(f"Subtitle language: {lang}")
+    else:
+        lang = None
+    return FileRecord(channel_id, vid_type, lang, original_location, expected_location)
+
+class FileType(enum.Enum):
+    VIDEO = 'video'
+    SUBTITLE = 'subtitle'
+    OTHER = 'other'
+
+
+def relative_to_source(path):
+    source_dir = args.SOURCE_DIR.rstrip('/') + '/'
+    return path[len(source_dir):] if path.startswith(source_dir) else path
+
+
+class FileRecord(object):
+    """A file to migrate and where it is expected to end up.
+
+    Locations are stored relative to SOURCE_DIR, and channel IDs and languages are
+    interned, so the many records of a large library stay small.
+    """
+    __slots__ = ('channel_id', 'type', 'lang', 'original', 'expected')
+
+    def __init__(self, channel_id, type, lang, original_location, expected_location):
+        self.channel_id = sys.intern(channel_id)
+        self.type = type
+        self.lang = sys.intern(lang) if lang is not None else None
+        self.original = relative_to_source(original_location)
+        self.expected = relative_to_source(expected_location)
+
+    @property
+    def original_location(self):
+        return os.path.join(args.SOURCE_DIR, self.original)
+
+    @property
+    def expected_location(self):
+        return os.path.join(args.SOURCE_DIR, self.expected)
+
+    def to_dict(self):
+        det = {'channel_id': self.channel_id, 'type': self.type.value, 'original_location': self.original_location, 'expected_location': self.expected_location}
+        if self.type == FileType.SUBTITLE:
+            det['lang'] = self.lang
+        return det
+
+    @classmethod
+    def from_dict(cls, det):
+        return cls(det['channel_id'], FileType(det['type']), det.get('lang'), det['original_location'], det['expected_location'])
+
+    def to_list(self):
+        return [self.channel_id, self.type.value, self.lang, self.original, self.expected]
+
+    @classmethod
+    def from_list(cls, values):
+        channel_id, type, lang, original, expected = values
+        return cls(channel_id, FileType(type), lang, original, expected)
 
 
-def review_filesystem(dir):
-    # Walk through the /youtube directory
-    print("Calculating number of files to process...")
-    file_count = sum(len(files) for _, _, files in os.walk(dir))
-    dprint(f"Total files found: {file_count}")
-    video_files = {}
-    all_files = []
-    current_count = 0
+class ComparisonEntry(object):
+    """The comparison result of a single video: the outcome of its secondary search and its files."""
+    __slots__ = ('secondary_result', 'details')
+
+    def __init__(self, secondary_result, details):
+        self.secondary_result = secondary_result
+        self.details = details
+
+    def to_dict(self):
+        return {"secondary_result": self.secondary_result, "details": self.details}
+
+
+def json_default(obj):
+    # Lets the compact record types be written wherever the results are serialized.
+    if isinstance(obj, (FileRecord, ComparisonEntry)):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class ScanSnapshot(object):
+    """Directory listings and file records from the previous scan of SOURCE_DIR.
+
+    A directory whose inode and mtime are unchanged since the previous scan has the
+    same entries, so its listing and the records built for its files can be reused
+    without reading the directory or resolving channels again.
+    """
+    VERSION = 2
+
+    def __init__(self, path, source_dir, guess_types):
+        self.path = path
+        self.header = {"version": self.VERSION, "source_dir": os.path.abspath(source_dir), "guess_types": guess_types}
+        self.directories = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Unable to read the scan snapshot at `{self.path}`. Performing a full scan: {e}")
+            return
+        if data.get("header") != self.header:
+            print("The scan snapshot was taken with different options. Performing a full scan.")
+            return
+        self.directories = data["directories"]
+        print(f"Loaded scan snapshot with {len(self.directories)} directories from `{self.path}`.")
+
+    def save(self, directories):
+        # Written to a temporary file first so an interrupted save never leaves a truncated snapshot.
+        temp_path = f"{self.path}.tmp"
+        try:
+            with gzip.open(temp_path, 'wt') as f:
+                json.dump({"header": self.header, "directories": directories}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Unable to write the scan snapshot to `{self.path}`: {e}")
+
+def listing_unchanged(path, files):
+    """Returns whether every file of a snapshot listing of `path` still has the same inode, size and mtime."""
+    for name, size, inode, mtime in files:
+        file_path = os.path.join(path, name)
+        try:
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                file_stat = os.lstat(file_path)
+        except OSError:
+            return False
+        if (file_stat.st_size, file_stat.st_ino, file_stat.st_mtime) != (size, inode, mtime):
+            return False
+    return True
+
+def scan_directory(top, previous=None, check_files=False):
+    """Walks `top` in a single pass, yielding each directory with stat details of its files.
+
+    Directories are visited top-down in the same order as `os.walk`, and symlinked
+    directories are not followed. Directories found unchanged in `previous` are not
+    read again; their listing is taken from it and they are yielded as cached. With
+    `check_files`, a file rewritten in place also counts as a change, since that does
+    not change the directory itself.
+    """
+    previous = previous or {}
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        files = []
+        subdirs = []
+        try:
+            dir_stat = os.stat(path)
+            known = previous.get(path)
+            if known and known["inode"] == dir_stat.st_ino and known["mtime"] == dir_stat.st_mtime_ns and (not check_files or listing_unchanged(path, known["files"])):
+                files = [ScannedFile(os.path.join(path, name), name, size, inode, mtime) for name, size, inode, mtime in known["files"]]
+                yield ScannedDirectory(path, dir_stat.st_ino, dir_stat.st_mtime_ns, files, known["subdirs"], True)
+                stack.extend(reversed(known["subdirs"]))
+                continue
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                            continue
+                        try:
+                            entry_stat = entry.stat()
+                        except OSError:
+                            entry_stat = entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        print(f"Unable to read `{entry.path}`: {e}")
+                        continue
+                    files.append(ScannedFile(entry.path, entry.name, entry_stat.st_size, entry_stat.st_ino, entry_stat.st_mtime))
+        except OSError as e:
+            print(f"Unable to read directory `{path}`: {e}")
+            continue
+        yield ScannedDirectory(path, dir_stat.st_ino, dir_stat.st_mtime_ns, files, subdirs, False)
+        stack.extend(reversed(subdirs))
+
+class ChannelInference(object):
+    """Works out the channel of a legacy channel directory from a few of its videos.
+
+    Every video in a legacy channel directory belongs to the same channel. If other
+    videos in the directory already have a single known channel, it is used as is;
+    otherwise a small sample of the directory's videos is looked up. When they agree,
+    the rest of the directory gets that channel without a lookup of its own. When they
+    do not, every video is looked up as usual.
+    """
+    def __init__(self, root, resolver, known, videos, sample_size=2):
+        self.root = root
+        self.resolver = resolver
+        self.known = set(known)
+        self.videos = videos
+        self.sample = {}
+        if not self.known:
+            self.sample = {video_id: resolver.submit(video_id) for video_id in videos[:max(1, sample_size)]}
+        self.channel_id = None
+        self.checked = False
+
+    def _check(self):
+        self.checked = True
+        channels = self.known | {future.result() for future in self.sample.values()}
+        channels.discard(None)
+        if len(channels) == 1:
+            self.channel_id = channels.pop()
+            source = "other videos in the directory" if self.known else f"{len(self.sample)} sampled videos"
+            print(f"Inferred channel {self.channel_id} for {len(self.videos)} videos in `{self.root}` from {source}.")
+            metrics.add("inferred_channels", len(self.videos) - len(self.sample))
+            if args.WRITE_CHANNEL_ID:
+                write_channel_id_file(self.root, self.channel_id)
+        else:
+            print(f"Videos in `{self.root}` do not agree on a channel ({', '.join(sorted(channels)) or 'none found'}). Looking up each video instead.")
+            for video_id in self.videos:
+                self.resolver.submit(video_id)
+
+    def resolve(self, video_id):
+        if not self.checked:
+            self._check()
+        if video_id in self.sample:
+            return self.sample[video_id].result() or self.channel_id
+        return self.channel_id or self.resolver.submit(video_id).result()
+
+def parse_directory(scanned_dir):
+    """Extracts the parts of every legacy-looking filename in a scanned directory.
+
+    Returns `(file, video_id, ext, lang)` for each legacy-looking file, with `video_id`
+    set to None when it is not usable, whether the directory has a `channel.id` file,
+    and the channel ID read from it.
+    """
+    matches = []
+    for file in scanned_dir.files:
+        match = legacy_filename_rx.search(file.name)
+        if match:
+            video_id = match.group('video_id') if match.start() == 0 and match.group('separator') else None
+            matches.append((file, video_id, match.group('ext') or '', match.group('lang') or ''))
+    has_channel_file = any(file.name == "channel.id" for file in scanned_dir.files)
+    dir_channel_id = None
+    if has_channel_file and any(video_id for _, video_id, _, _ in matches):
+        dir_channel_id = read_channel_id_file(scanned_dir.path)
+    return matches, has_channel_file, dir_channel_id
+
+def scan_shard(top, previous, check_files=False):
+    # Runs in a worker process, so it returns plain data for the whole directory tree.
+    return [(scanned_dir, None if scanned_dir.cached else parse_directory(scanned_dir)) for scanned_dir in scan_directory(top, previous, check_files)]
+
+def scan_source_dir(top, previous, workers=1, check_files=False):
+    """Walks `top` and parses its filenames, yielding each directory with its parsed files.
+
+    With more than one worker, every top-level directory of `top` is walked and parsed
+    in a separate process. The results are yielded in the same order as a single walk,
+    so the outcome does not depend on the number of workers.
+    """
+    if workers <= 1:
+        for scanned_dir in scan_directory(top, previous, check_files):
+            yield scanned_dir, None if scanned_dir.cached else parse_directory(scanned_dir)
+        return
+    walk = scan_directory(top, previous, check_files)
+    top_dir = next(walk, None)
+    walk.close()
+    if top_dir is None:
+        return
+    yield top_dir, None if top_dir.cached else parse_directory(top_dir)
+    # Each worker is only sent the part of the snapshot for its own directory.
+    prefix = os.path.join(top, '')
+    shards = {subdir: {} for subdir in top_dir.subdirs}
+    for path, known in (previous or {}).items():
+        if path.startswith(prefix):
+            shard = shards.get(prefix + path[len(prefix):].split('/', 1)[0])
+            if shard is not None:
+                shard[path] = known
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for results in executor.map(scan_shard, top_dir.subdirs, [shards[subdir] for subdir in top_dir.subdirs], itertools.repeat(check_files)):
+            yield from results
+
+def review_filesystem(dir, resolver, cache, es_video_ids, snapshot, sniffer=None, pipeline=None, store=None):
+    # With a comparison store, files and records are written to it instead of being
+    # returned, and `video_files` is None.
+    video_files = None if store else {}
+    all_files = StoredFileIndex(store, dir) if store else FileIndex(dir, es_video_ids.keys())
+    dir_count = 0
+    file_count = 0
+    cached_count = 0
+    # Channel lookups are queued on the resolver while the walk continues. Each entry
+    # holds either a resolved channel ID or a future for one.
+    video_channels = {}
+    pending_files = []
+    # Videos with files waiting for their lookup. Their channels are kept until the end of the scan.
+    queued_videos = set()
+    # Listing and records of every directory, saved as the snapshot for the next scan.
+    directories = {}
+    failed_dirs = set()
+
+    def add_record(video_id, det):
+        if store:
+            store.insert("fs_records", (video_id, json.dumps(det.to_list())))
+        else:
+            video_files.setdefault(video_id, []).append(det)
 
     print("Processing video files...")
-    for root, _, files in os.walk(dir):
-        for filename in files:
-            current_count += 1
-            all_files.append(os.path.join(root,filename))
-            match = re.search(rx, filename, re.IGNORECASE)
-            if match:
-                video_id = extract_video_id(filename)
-                print(f"[{current_count}/{file_count}] Matching file: {filename} | Extracted Video ID: {video_id}")
-                if video_id:
-                    original_location = os.path.join(root, filename)
-                    if video_files.get(video_id):
-                        channel_id = video_files[video_id][0]['channel_id']
-                    elif os.path.exists(os.path.join(root,"channel.id")):
-                        with open(os.path.join(root,"channel.id"), 'r') as channel_file:
-                            for line in channel_file.readlines():
-                                if len(line) > 0:
-                                    channel_id = line.strip()
-                    else:
-                        channel_id = get_channel_id(video_id)
-                    if channel_id:
-                        expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}{os.path.splitext(filename)[-1]}")
-                        if not video_files.get(video_id):
-                            video_files[video_id] = []
-                        vid_type = None
-                        lang = None
-                        if args.GUESS_TYPES:
-                            try:
-                                file_mimetype = mimetypes.guess_type(original_location)[0]
-                                dprint(f"Detected mimetype: {file_mimetype}")
-                                lines = []
-                                if file_mimetype == None:
-                                    try:
-                                        with open(original_location, 'r') as f:
-                                            set_subtitle = False
-                                            set_language = False
-                                            counter = 0
-                                            while True:
-                                                line = f.readline()
-                                                counter += 1
-                                                if not line:
-                                                    vid_type = 'other'
-                                                    break
-                                                if counter == 1:
-                                                    dprint(f"File first line [Expect `WEBVTT`]: {line.strip()}")
-                                                if counter == 3:
-                                                    dprint(f"File third line [Expect `Language: XX`]: {line.strip()}")
-                                                if "WEBVTT" in line:
-                                                    set_subtitle = True
-                                                    vid_type = 'subtitle'
-                                                    expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}{os.path.splitext(filename)[-1]}")
-                                                if "Language: " in line:
-                                                    set_language = True
-                                                    lang = line.strip().split()[-1].strip().lower()
-                                                    expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}.{lang}{os.path.splitext(filename)[-1]}")
-                                                if set_subtitle and set_language:
-                                                    break
-                                    except Exception as e:
-                                        print(f"An error occurred while attempting to determine filetype for {filename}: {e}")
-                                        vid_type = 'other'
-                                elif "vtt" in file_mimetype:
-                                    vid_type = 'subtitle'
-                                    try:
-                                        with open(original_location, 'r') as f:
-                                            set_subtitle = False
-                                            set_language = False
-                                            counter = 0
-                                            while True:
-                                                line = f.readline()
-                                                counter += 1
-                                                if not line:
-                                                    vid_type = 'other'
-                                                    break
-                                                if counter == 1:
-                                                    dprint(f"File first line [Expect `WEBVTT`]: {line.strip()}")
-                                                if counter == 3:
-                                                    dprint(f"File third line [Expect `Language: XX`]: {line.strip()}")
-                                                if "WEBVTT" in line:
-                                                    set_subtitle = True
-                                                    vid_type = 'subtitle'
-                                                    expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}{os.path.splitext(filename)[-1]}")
-                                                if "Language: " in line:
-                                                    set_language = True
-                                                    lang = line.strip().split()[-1].strip().lower()
-                                                    expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}.{lang}{os.path.splitext(filename)[-1]}")
-                                                if set_subtitle and set_language:
-                                                    break
-                                    except Exception as e:
-                                        print(f"An error occurred while attempting to determine filetype for {filename}: {e}")
-                                        vid_type = 'other'
-                                elif "video" in file_mimetype:
-                                    vid_type = 'video'
-                                else:
-                                    vid_type = 'other'
-                            except TypeError as e:
-                                print(f"An error occurred while attempting to guess the filetype for {filename}: {e}")
-                                vid_type = 'other'
+    # The previous scan, if there is one, gives an estimate of the files left.
+    progress.start("Scanning", "files", sum(len(directory["files"]) for directory in snapshot.directories.values()) or None)
+    for scanned_dir, parsed in scan_source_dir(dir, snapshot.directories, args.SCAN_WORKERS, check_files=args.GUESS_TYPES):
+        dir_count += 1
+        root = scanned_dir.path
+        relative_paths = {file.name: all_files.add(file.path) for file in scanned_dir.files}
+        file_count += len(scanned_dir.files)
+        progress.advance(len(scanned_dir.files))
+        if scanned_dir.cached:
+            cached_count += 1
+            directories[root] = snapshot.directories[root]
+            ready = {}
+            records = directories[root]["records"]
+            dir_es_videos = es_video_ids.select(set(video_id for video_id, _ in records)) if store and pipeline else es_video_ids
+            for video_id, values in records:
+                det = FileRecord.from_list(values)
+                video_id = sys.intern(video_id)
+                if store:
+                    add_record(video_id, det)
+                else:
+                    video_channels.setdefault(video_id, det.channel_id)
+                    pending_files.append((video_id, root, None, None, None, None, None, det))
+                if pipeline and video_id in dir_es_videos:
+                    ready.setdefault(video_id, []).append(det)
+            for video_id, records in ready.items():
+                pipeline.put(video_id, records)
+            continue
+        directories[root] = {
+            "inode": scanned_dir.inode,
+            "mtime": scanned_dir.mtime,
+            "files": [[file.name, file.size, file.inode, file.mtime] for file in scanned_dir.files],
+            "subdirs": scanned_dir.subdirs,
+            "records": []
+        }
+        matches, has_channel_file, dir_channel_id = parsed
+        # A comparison store is asked for all of the directory's videos at once, instead of once per file.
+        dir_es_videos = es_video_ids.select(set(video_id for _, video_id, _, _ in matches if video_id)) if store else es_video_ids
+        ready = {}
+        # Channels already known for videos in this directory, and videos still without one.
+        dir_channels = set()
+        unresolved = []
+        for file, video_id, ext, name_lang in matches:
+            filename = file.name
+            if video_id:
+                video_id = sys.intern(video_id)
+            vprint(f"[{dir_count} dirs/{file_count} files] Matching file: {filename} | Extracted Video ID: {video_id}")
+            if video_id:
+                # A channel already known for the video is kept. A lookup that is still
+                # outstanding, or has failed, is replaced if this sighting can resolve it.
+                if not isinstance(video_channels.get(video_id), str):
+                    if has_channel_file and dir_channel_id:
+                        video_channels[video_id] = dir_channel_id
+                        cache.put(video_id, video_channels[video_id], "channel.id")
+                    elif dir_es_videos.get(video_id, {}).get('channel_id'):
+                        video_channels[video_id] = dir_es_videos[video_id]['channel_id']
+                        cache.put(video_id, video_channels[video_id], "es")
+                    elif video_id not in video_channels:
+                        channel_id = cache.get(video_id)
+                        if channel_id or not args.INFER_CHANNELS:
+                            video_channels[video_id] = channel_id or resolver.submit(video_id)
                         else:
-                            if os.path.splitext(filename)[-1] in ['.mp4']:
-                                vid_type = 'video'
-                            elif os.path.splitext(filename)[-1] in ['.vtt']:
-                                vid_type = 'subtitle'
-                                lang = os.path.splitext(os.path.splitext(filename)[0])[-1].translate(str.maketrans('', '', string.punctuation))
-                                expected_location = os.path.join(os.path.join(dir, channel_id),f"{video_id}.{lang}{os.path.splitext(filename)[-1]}")
-                            else:
-                                vid_type = 'other'
-                        det = {'channel_id': channel_id, 'type': vid_type, 'original_location': original_location, 'expected_location': expected_location}
-                        dprint(f"File is of type: {vid_type}")
-                        if vid_type == 'subtitle':
-                            dprint(f"Subtitle language: {lang}")
-                            det['lang'] = lang
-                        video_files[video_id].append(det)
+                            # Resolved for the whole directory once it has been read.
+                            video_channels[video_id] = None
+                            unresolved.append(video_id)
+                    if isinstance(video_channels.get(video_id), str):
+                        dir_channels.add(video_channels[video_id])
+                # Content is sniffed in the background while the walk and lookups continue.
+                sniffed = sniffer.submit(file.path, file.inode, file.size, file.mtime) if sniffer else None
+                channel_id = video_channels[video_id]
+                migrate_now = pipeline and isinstance(channel_id, str) and video_id in dir_es_videos
+                if migrate_now or store and isinstance(channel_id, str):
+                    # Records that need no lookup are built now, to be migrated during the
+                    # scan if the video is already known to be in both, or spilled to the store.
+                    det = build_file_record(dir, root, filename, video_id, channel_id, ext, name_lang, sniffed)
+                    det.original = relative_paths[filename]
+                    directories[root]["records"].append([video_id, det.to_list()])
+                    if migrate_now:
+                        ready.setdefault(video_id, []).append(det)
+                    if store:
+                        add_record(video_id, det)
                     else:
-                        print(f"Could not extract channel ID for `{filename}`.")
+                        pending_files.append((video_id, root, None, None, None, None, None, det))
                 else:
-                    print(f"Could not extract video ID for `{filename}`.")
-    dprint(f"All video files: {video_files}.")
-    dprint(f"All files in filesystem: {all_files}")
+                    pending_files.append((video_id, root, filename, relative_paths[filename], ext, name_lang, sniffed, None))
+                    queued_videos.add(video_id)
+            else:
+                vprint(f"Could not extract video ID for `{filename}`.")
+        for video_id, records in ready.items():
+            pipeline.put(video_id, records)
+        if unresolved:
+            inference = ChannelInference(root, resolver, dir_channels, unresolved, args.INFER_SAMPLE)
+            for video_id in unresolved:
+                video_channels[video_id] = inference
+        if store:
+            # Only channels that queued files still need are kept. A video found again in another
+            # directory has its channel looked up again from `channel.id`, ElasticSearch or the cache.
+            for _, video_id, _, _ in matches:
+                if video_id not in queued_videos and isinstance(video_channels.get(video_id), str):
+                    del video_channels[video_id]
+    progress.finish()
+    print(f"Scanned {file_count} files in {dir_count} directories, {cached_count} of them unchanged since the previous scan.")
+
+    print("Waiting for outstanding channel ID lookups...")
+    progress.start("Resolving channels", "files", len(pending_files))
+    for video_id, root, filename, relative_path, ext, name_lang, sniffed, det in pending_files:
+        progress.advance()
+        if det is None:
+            channel_id = video_channels[video_id]
+            if isinstance(channel_id, Future):
+                channel_id = channel_id.result()
+                video_channels[video_id] = channel_id
+                cache.put(video_id, channel_id, "lookup")
+            elif isinstance(channel_id, ChannelInference):
+                channel_id = channel_id.resolve(video_id)
+                video_channels[video_id] = channel_id
+                cache.put(video_id, channel_id, "inferred")
+            if not channel_id:
+                print(f"Could not extract channel ID for `{filename}`.")
+                # Leave the directory out of the snapshot so the lookup is retried next time.
+                failed_dirs.add(root)
+                continue
+            det = build_file_record(dir, root, filename, video_id, channel_id, ext, name_lang, sniffed)
+            # Share the path string already held by the file index.
+            det.original = relative_path
+            directories[root]["records"].append([video_id, det.to_list()])
+        add_record(video_id, det)
+    progress.finish()
+    for root in failed_dirs:
+        directories.pop(root, None)
+    snapshot.save(directories)
+    # Only counts, since the files of every video are in the comparison results.
+    if args.DEBUG and store:
+        dprint(f"All video files and all files in filesystem written to `{store.path}`: {len(all_files)} files.")
+    elif args.DEBUG:
+        dprint(f"All video files: {len(video_files)} videos. All files in filesystem: {len(all_files)} files.")
     return video_files, all_files
 
-def compare_es_filesystem(video_files, all_files, source):
-    es_video_ids = get_video_ids_from_es()
+class ReportWriter(object):
+    """Writes the comparison results as one JSON document, or streams one JSON record per video.
+
+    In `ndjson` mode every video is written as soon as it has been classified, so the
+    report can be consumed while the run continues and is never held as one string.
+    """
+    def __init__(self, output_format='json', path=None):
+        self.output_format = output_format
+        self.path = path
+        self.output = open(path, 'w', buffering=1) if path else sys.stdout
+
+    def write(self, category, video_id, entry):
+        if self.output_format == 'ndjson':
+            self.output.write(json.dumps({"category": category, "video_id": video_id, **entry.to_dict()}, default=json_default) + "\n")
+
+    def _write_document(self, results):
+        # Written one video at a time, so results kept in the comparison store are never loaded at once.
+        self.output.write("{")
+        for i, (category, entries) in enumerate(results.items()):
+            self.output.write(f"{', ' if i else ''}{json.dumps(category)}: {{")
+            for j, (video_id, entry) in enumerate(entries.items()):
+                self.output.write(f"{', ' if j else ''}{json.dumps(video_id)}: {json.dumps(entry, default=json_default)}")
+            self.output.write("}")
+        self.output.write("}")
+
+    def close(self, results):
+        if self.output_format == 'json':
+            if self.path:
+                self._write_document(results)
+            else:
+                print("-"*150)
+                self._write_document(results)
+                print()
+                print("-"*150)
+        if self.path:
+            self.output.close()
+            print(f"Comparison results written to `{self.path}`.")
+        else:
+            self.output.flush()
+
+class ComparisonStore(object):
+    """SQLite database the comparison is spilled to when DISK_COMPARE is set.
+
+    It holds the videos loaded from ElasticSearch, every file and record found by the
+    scan, and the comparison results, so none of them has to fit in memory. Writes are
+    batched, and reads are paged by key so a long read never holds the database. The
+    contents only matter for a single run and are recreated by the next one.
+    """
+    WRITE_BATCH = 5000
+    PAGE_SIZE = 1000
+
+    def __init__(self, path):
+        self.path = path
+        for suffix in ("", "-journal"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path + suffix)
+        # Written to by the ElasticSearch slices and read by the migration threads.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.executescript("""
+            CREATE TABLE es_videos (video_id TEXT PRIMARY KEY, video TEXT NOT NULL);
+            CREATE TABLE fs_records (video_id TEXT NOT NULL, record TEXT NOT NULL);
+            CREATE INDEX fs_records_video_id ON fs_records (video_id);
+            CREATE TABLE paths (path TEXT NOT NULL);
+            CREATE TABLE path_ids (video_id TEXT NOT NULL, path TEXT NOT NULL);
+            CREATE INDEX path_ids_video_id ON path_ids (video_id);
+            CREATE TABLE indexed_ids (video_id TEXT PRIMARY KEY);
+            CREATE TABLE results (category TEXT NOT NULL, video_id TEXT NOT NULL, secondary_result TEXT NOT NULL, details TEXT NOT NULL, PRIMARY KEY (category, video_id));
+        """)
+        self.lock = threading.RLock()
+        self.pending = {}
+
+    def insert(self, table, row):
+        with self.lock:
+            rows = self.pending.setdefault(table, [])
+            rows.append(row)
+            if len(rows) >= self.WRITE_BATCH:
+                self._flush(table)
+
+    def _flush(self, table):
+        rows = self.pending.pop(table, None)
+        if rows:
+            self.conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+
+    def execute(self, sql, params=(), tables=None):
+        """Runs `sql` once the batched writes to `tables` have been applied, and returns all of its rows.
+
+        Without `tables`, every batched write is applied first. Reads made while other
+        tables are being filled, such as the lookups of the scan, name the tables they
+        read so they do not cut those batches short.
+        """
+        with self.lock:
+            for table in list(self.pending) if tables is None else tables:
+                self._flush(table)
+            return self.conn.execute(sql, params).fetchall()
+
+    def scan(self, table, key, columns=None, where="", params=()):
+        """Yields the rows of `table` in order of the columns in `key`, followed by `columns`.
+
+        Each page starts after the last key of the one before, so writes made between
+        pages are safe.
+        """
+        key_size = len(key.split(','))
+        select = f"{key}, {columns}" if columns else key
+        last = None
+        while True:
+            if last is None:
+                rows = self.execute(f"SELECT {select} FROM {table} WHERE 1 {where} ORDER BY {key} LIMIT {self.PAGE_SIZE}", params, (table,))
+            else:
+                rows = self.execute(f"SELECT {select} FROM {table} WHERE ({key}) > ({', '.join('?' * key_size)}) {where} ORDER BY {key} LIMIT {self.PAGE_SIZE}", (*last, *params), (table,))
+            yield from rows
+            if len(rows) < self.PAGE_SIZE:
+                return
+            last = rows[-1][:key_size]
+
+    def close(self):
+        with self.lock:
+            self.pending = {}
+            self.conn.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+class StoredVideos(collections.abc.Mapping):
+    """The videos loaded from ElasticSearch, kept in the comparison store and iterated in video ID order."""
+    # Kept below SQLite's oldest limit on the number of parameters in a query.
+    SELECT_BATCH = 500
+
+    def __init__(self, store):
+        self.store = store
+
+    def __setitem__(self, video_id, video):
+        self.store.insert("es_videos", (video_id, json.dumps(video)))
+
+    def __getitem__(self, video_id):
+        rows = self.store.execute("SELECT video FROM es_videos WHERE video_id = ?", (video_id,), ("es_videos",))
+        if not rows:
+            raise KeyError(video_id)
+        return json.loads(rows[0][0])
+
+    def get(self, video_id, default=None):
+        # A single query, instead of the membership test and lookup of Mapping.get.
+        try:
+            return self[video_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, video_id):
+        return bool(self.store.execute("SELECT 1 FROM es_videos WHERE video_id = ?", (video_id,), ("es_videos",)))
+
+    def select(self, video_ids):
+        """Returns the stored videos among `video_ids` as a dict, with one query per SELECT_BATCH IDs."""
+        video_ids = list(video_ids)
+        videos = {}
+        for i in range(0, len(video_ids), self.SELECT_BATCH):
+            batch = video_ids[i:i + self.SELECT_BATCH]
+            rows = self.store.execute(f"SELECT video_id, video FROM es_videos WHERE video_id IN ({', '.join('?' * len(batch))})", batch, ("es_videos",))
+            videos.update((video_id, json.loads(video)) for video_id, video in rows)
+        return videos
+
+    def __iter__(self):
+        return (row[0] for row in self.store.scan("es_videos", "video_id"))
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM es_videos", tables=("es_videos",))[0][0]
+
+    def clear(self):
+        self.store.execute("DELETE FROM es_videos", tables=("es_videos",))
+
+
+class StoredFileIndex(object):
+    """FileIndex kept in the comparison store.
+
+    Paths are only indexed by video ID for the IDs passed to `index`, with one pass over
+    every path per call, since the IDs worth indexing are only known once the
+    comparison has found the videos missing from the filesystem.
+    """
+    INDEX_BATCH = 100000
+
+    def __init__(self, store, root):
+        self.store = store
+        self.root = root.rstrip('/') + '/'
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM paths", tables=("paths",))[0][0]
+
+    def __iter__(self):
+        return (self.root + row[1] for row in self.store.scan("paths", "rowid", "path"))
+
+    def add(self, path):
+        relative = path[len(self.root):] if path.startswith(self.root) else path
+        self.store.insert("paths", (relative,))
+        return relative
+
+    def index(self, video_ids):
+        for i in range(0, len(video_ids), self.INDEX_BATCH):
+            batch = set(video_ids[i:i + self.INDEX_BATCH])
+            for _, path in self.store.scan("paths", "rowid", "path"):
+                for video_id in batch.intersection(video_id_window_rx.findall(path)):
+                    self.store.insert("path_ids", (video_id, path))
+            for video_id in batch:
+                self.store.insert("indexed_ids", (video_id,))
+
+    def find(self, video_ids):
+        found = []
+        for video_id in video_ids:
+            if self.store.execute("SELECT 1 FROM indexed_ids WHERE video_id = ?", (video_id,), ("indexed_ids",)):
+                rows = self.store.execute("SELECT path FROM path_ids WHERE video_id = ? ORDER BY rowid", (video_id,), ("path_ids",))
+            else:
+                rows = self.store.execute("SELECT path FROM paths WHERE instr(path, ?) ORDER BY rowid", (video_id,), ("paths",))
+            found.extend(self.root + row[0] for row in rows)
+        return found
+
+
+class StoredResults(collections.abc.Mapping):
+    """The comparison results of one category, kept in the comparison store and read back as they are used."""
+    def __init__(self, store, category):
+        self.store = store
+        self.category = category
+
+    def add(self, video_id, entry):
+        self.store.insert("results", (self.category, video_id, entry.secondary_result, json.dumps([det.to_list() for det in entry.details])))
+
+    @staticmethod
+    def _entry(secondary_result, details):
+        return ComparisonEntry(secondary_result, [FileRecord.from_list(det) for det in json.loads(details)])
+
+    def __getitem__(self, video_id):
+        rows = self.store.execute("SELECT secondary_result, details FROM results WHERE category = ? AND video_id = ?", (self.category, video_id), ("results",))
+        if not rows:
+            raise KeyError(video_id)
+        return self._entry(*rows[0])
+
+    def __iter__(self):
+        return (row[0] for row in self.store.scan("results", "video_id", where="AND category = ?", params=(self.category,)))
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM results WHERE category = ?", (self.category,), ("results",))[0][0]
+
+    def items(self):
+        return ((video_id, self._entry(secondary_result, details)) for video_id, secondary_result, details in self.store.scan("results", "video_id", "secondary_result, details", "AND category = ?", (self.category,)))
+
+
+def merge_video_ids(es_video_ids, fs_videos):
+    """Merges sorted ElasticSearch video IDs with sorted `(video_id, records)` from the filesystem.
+
+    Yields `(video_id, in_es, records)`, where `records` is None for videos that are
+    only in ElasticSearch.
+    """
+    es_video_id = next(es_video_ids, None)
+    fs_video_id, records = next(fs_videos, (None, None))
+    while es_video_id is not None or fs_video_id is not None:
+        if fs_video_id is None or es_video_id is not None and es_video_id < fs_video_id:
+            yield es_video_id, True, None
+            es_video_id = next(es_video_ids, None)
+        elif es_video_id is None or fs_video_id < es_video_id:
+            yield fs_video_id, False, records
+            fs_video_id, records = next(fs_videos, (None, None))
+        else:
+            yield es_video_id, True, records
+            es_video_id = next(es_video_ids, None)
+            fs_video_id, records = next(fs_videos, (None, None))
+
+def stored_fs_videos(store):
+    """Yields `(video_id, records)` for every video found by the scan, in video ID order."""
+    rows = store.scan("fs_records", "video_id, rowid", "record")
+    for video_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield video_id, [FileRecord.from_list(json.loads(row[2])) for row in group]
+
+def es_file_records(source, video_id, video):
+    """Builds the records of the files ElasticSearch has for a video loaded by `get_video_ids_from_es`."""
+    if not video.get('channel_id'):
+        # Without a channel there is no expected location to migrate to.
+        return []
+    pull = []
+    pull.append(FileRecord(
+        video['channel_id'],
+        FileType.VIDEO,
+        None,
+        os.path.join(source, video['media_url']),
+        os.path.join(os.path.join(source, video['channel_id']), f"{video_id}.mp4")
+    ))
+    for sub in video.get('subtitles') or []:
+        pull.append(FileRecord(
+            video['channel_id'],
+            FileType.SUBTITLE,
+            sub['lang'],
+            os.path.join(source, sub['media_url']),
+            os.path.join(os.path.join(source, video['channel_id']), f"{video_id}.{sub['lang']}.vtt")
+        ))
+    return pull
+
+def compare_stored(store, all_files, source, es_video_ids, report):
+    """Compares the filesystem and ElasticSearch videos spilled to the comparison store.
+
+    Both sides are read back in video ID order and merged, so each video is classified
+    as soon as it is reached. Secondary searches are batched over ES_BATCH_SIZE videos,
+    and the filesystem is indexed for the videos missing from it in one pass per
+    StoredFileIndex.INDEX_BATCH of them.
+    """
+    print("Comparing Filesystem and ElasticSearch results.")
+    results = {category: StoredResults(store, category) for category in ("InFSNotES", "InESNotFS", "InESInFS")}
+    fs_only = {}
+    es_only = []
+
+    def check_fs_only():
+        secondary_es = check_video_ids_from_es(fs_only.keys(), args.ES_BATCH_SIZE)
+        for video_id, records in fs_only.items():
+            if video_id in secondary_es:
+                secondary_result = "Secondary Search Found Result"
+            else:
+                secondary_result = "Not Found In ElasticSearch"
+            entry = ComparisonEntry(secondary_result, records)
+            results["InFSNotES"].add(video_id, entry)
+            report.write("InFSNotES", video_id, entry)
+        fs_only.clear()
+
+    def check_es_only():
+        all_files.index(es_only)
+        for i in range(0, len(es_only), args.ES_BATCH_SIZE):
+            batch = es_only[i:i + args.ES_BATCH_SIZE]
+            # The documents were already loaded from ElasticSearch with every field needed.
+            videos = es_video_ids.select(batch)
+            for video_id in batch:
+                if check_filesystem_for_video_ids(all_files, [video_id]):
+                    secondary_result = "Secondary Search Found Result"
+                else:
+                    secondary_result = "Not Found In Filesystem"
+                pull = es_file_records(source, video_id, videos[video_id]) if video_id in videos else []
+                entry = ComparisonEntry(secondary_result, pull)
+                results["InESNotFS"].add(video_id, entry)
+                report.write("InESNotFS", video_id, entry)
+        es_only.clear()
+
+    counts = collections.Counter()
+    # Videos are classified before the merge reaches the end of both sides, so there is no total.
+    progress.start("Comparing", "videos")
+    for video_id, in_es, records in merge_video_ids(iter(es_video_ids), stored_fs_videos(store)):
+        progress.advance()
+        if in_es and records:
+            counts["both"] += 1
+            entry = ComparisonEntry("Not Required - Present In Both", records)
+            results["InESInFS"].add(video_id, entry)
+            report.write("InESInFS", video_id, entry)
+        elif records:
+            counts["fs"] += 1
+            fs_only[video_id] = records
+            if len(fs_only) >= args.ES_BATCH_SIZE:
+                check_fs_only()
+        else:
+            counts["es"] += 1
+            es_only.append(video_id)
+            if len(es_only) >= StoredFileIndex.INDEX_BATCH:
+                check_es_only()
+    if fs_only:
+        check_fs_only()
+    if es_only:
+        check_es_only()
+    progress.finish()
+    dprint(f"Filesystem videos: {counts['fs'] + counts['both']} | ElasticSearch videos: {counts['es'] + counts['both']}")
+    report.close(results)
+    return results
+
+def compare_es_filesystem(video_files, all_files, source, es_video_ids, report, store=None):
+    if store:
+        return compare_stored(store, all_files, source, es_video_ids, report)
     fs_video_ids_set = set(video_files.keys())
     es_video_ids_set = set(es_video_ids.keys())
 
@@ -425,59 +2137,55 @@ def compare_es_filesystem(video_files, all_files, source):
     videos_in_es_not_in_fs = es_video_ids_set - fs_video_ids_set
     videos_in_both = fs_video_ids_set.intersection(es_video_ids_set)
 
-    dprint(f"Filesystem videos: {fs_video_ids_set}")
-    dprint(f"ElasticSearch videos: {es_video_ids_set}")
+    dprint(f"Filesystem videos: {len(fs_video_ids_set)} | ElasticSearch videos: {len(es_video_ids_set)}")
     results = {}
+    progress.start("Comparing", "videos", len(videos_in_fs_not_in_es) + len(videos_in_es_not_in_fs) + len(videos_in_both))
+
+    # Secondary searches are batched so they cost a handful of requests regardless of library size.
+    secondary_es = check_video_ids_from_es(videos_in_fs_not_in_es, args.ES_BATCH_SIZE)
 
     results["InFSNotES"] = {}
     for video_id in videos_in_fs_not_in_es:
-        results["InFSNotES"][video_id] = {}
-        if check_video_id_from_es(video_id):
-            results["InFSNotES"][video_id]["secondary_result"] = "Secondary Search Found Result"
+        if video_id in secondary_es:
+            secondary_result = "Secondary Search Found Result"
         else:
-            results["InFSNotES"][video_id]["secondary_result"] = "Not Found In ElasticSearch"
-        results["InFSNotES"][video_id]["details"] = video_files[video_id]
+            secondary_result = "Not Found In ElasticSearch"
+        results["InFSNotES"][video_id] = ComparisonEntry(secondary_result, video_files[video_id])
+        report.write("InFSNotES", video_id, results["InFSNotES"][video_id])
+        progress.advance()
     results["InESNotFS"] = {}
     for video_id in videos_in_es_not_in_fs:
-        results["InESNotFS"][video_id] = {}
         if check_filesystem_for_video_ids(all_files, [video_id]):
-            results["InESNotFS"][video_id]["secondary_result"] = "Secondary Search Found Result"
+            secondary_result = "Secondary Search Found Result"
         else:
-            results["InESNotFS"][video_id]["secondary_result"] = "Not Found In Filesystem"
-        pull = []
-        res = pull_video_from_es(video_id)
-        for vid_id in res.keys():
-            pull.append({
-                'channel_id': res[vid_id]['channel_id'],
-                'type': 'video',
-                'original_location': os.path.join(source, res[vid_id]['media_url']),
-                'expected_location': os.path.join(os.path.join(source, res[vid_id]['channel_id']), f"{vid_id}.mp4")
-            })
-            if res[vid_id].get('subs'):
-                for sub in res[vid_id]['subs']:
-                    for lang, media_url in sub.items():
-                        pull.append({
-                            'channel_id': res[vid_id]['channel_id'],
-                            'type': 'subtitle',
-                            'original_location': os.path.join(source, media_url),
-                            'expected_location': os.path.join(os.path.join(source, res[vid_id]['channel_id']), f"{vid_id}.{lang}.vtt"),
-                            'lang': lang
-                        })
-        results["InESNotFS"][video_id]["details"] = pull
+            secondary_result = "Not Found In Filesystem"
+        # Built from the documents already loaded, without requesting them again.
+        pull = es_file_records(source, video_id, es_video_ids[video_id])
+        results["InESNotFS"][video_id] = ComparisonEntry(secondary_result, pull)
+        report.write("InESNotFS", video_id, results["InESNotFS"][video_id])
+        progress.advance()
     results["InESInFS"] = {}
     for video_id in videos_in_both:
-        results["InESInFS"][video_id] = {}
-        results["InESInFS"][video_id]["secondary_result"] = "Not Required - Present In Both"
-        results["InESInFS"][video_id]["details"] = video_files[video_id]
-    print("-"*150)
-    print(json.dumps(results))
-    print("-"*150)
+        results["InESInFS"][video_id] = ComparisonEntry("Not Required - Present In Both", video_files[video_id])
+        report.write("InESInFS", video_id, results["InESInFS"][video_id])
+        progress.advance()
+    progress.finish()
+    report.close(results)
     return results
 
 def prep_directory(root, source, channel_id):
+    """Creates `root/channel_id` with the owner and permissions of `source`.
+
+    Returns True if it was created, False if it already existed and None if it could not be prepared.
+    """
     dest_directory_path = os.path.join(root, channel_id)
+    created = False
     try:
-        os.makedirs(dest_directory_path, exist_ok=True)
+        try:
+            os.makedirs(dest_directory_path)
+            created = True
+        except FileExistsError:
+            pass
         source_stat = os.stat(source)
         uid = source_stat.st_uid
         gid = source_stat.st_gid
@@ -486,133 +2194,795 @@ def prep_directory(root, source, channel_id):
         os.chmod(dest_directory_path, permissions)
     except Exception as e:
         print(f"An error occurred during the directory prep function: {e}")
+        return None
+    return created
 
-def update_es_for_item(id, nmu, vid_type, lang):
-    new_media_url = nmu
-    if vid_type == 'subtitle':
-        lang_in_subs = False
-        subtitles = None
-        example_sub = {}
-        res = ElasticWrap("ta_video/_search").get(data={"query": {"match":{"_id": id}}})
-        if res[1] == 200:
-            res = res[0]
-        try:
-            subtitles = res['hits']['hits'][0]['_source']['subtitles']
-        except Exception as e:
-            print(f"No existing subtitles found for ID {id} in ElasticSearch. Continuing without adding new subtitles to ID.")
-            return 1
-        if subtitles:
+class DirectoryPreparer(object):
+    """Prepares each channel directory once per run, however many files are moved into it.
+
+    A directory that fails to prepare, e.g. because chown is not permitted, is not tried
+    again during the same run. It is left out of `prepared`, so a later run retries it.
+    """
+    def __init__(self, root, workers=4):
+        self.root = root
+        self.workers = workers
+        self.prepared = set()
+        self.failed_dirs = set()
+        self.created = 0
+        self.reused = 0
+        self.failed = 0
+
+    def prepare_all(self, directories):
+        """Prepares every `(channel_id, source directory)` pair that has not been prepared yet."""
+        todo = {}
+        for channel_id, source in directories:
+            if channel_id not in self.prepared and channel_id not in self.failed_dirs and channel_id not in todo:
+                todo[channel_id] = source
+        if not todo:
+            return
+        print(f"Preparing {len(todo)} channel directories.")
+        with ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="prep") as executor:
+            results = executor.map(lambda item: prep_directory(self.root, item[1], item[0]), todo.items())
+            for channel_id, created in zip(todo, results):
+                if created is None:
+                    self.failed_dirs.add(channel_id)
+                    self.failed += 1
+                    continue
+                if created:
+                    self.created += 1
+                else:
+                    self.reused += 1
+                self.prepared.add(channel_id)
+
+    def prepare(self, channel_id, source):
+        self.prepare_all([(channel_id, source)])
+
+    def summary(self):
+        return f"Channel directories: {self.created} created, {self.reused} already existed, {self.failed} failed."
+
+class BulkUpdater(object):
+    """Accumulates ElasticSearch updates per video and flushes them through the `_bulk` API.
+
+    The media URL and the merged subtitles of a video are collected into a single
+    partial document, starting from the subtitles already loaded from ElasticSearch,
+    and sent once the batch reaches `batch_size` videos or `flush_interval` seconds.
+    """
+    def __init__(self, es_video_ids, batch_size=500, flush_interval=5, on_updated=None):
+        self.es_video_ids = es_video_ids
+        self.on_updated = on_updated
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.subtitles = {}
+        self.last_flush = time.monotonic()
+        self.succeeded = 0
+        self.failed = 0
+
+    def _get_subtitles(self, id):
+        # Working copy that keeps every change made to a video's subtitles during this run.
+        if id not in self.subtitles:
+            subtitles = self.es_video_ids.get(id, {}).get('subtitles')
+            self.subtitles[id] = [dict(sub) for sub in subtitles] if subtitles else None
+        return self.subtitles[id]
+
+    def _skipped(self, id):
+        # Nothing will ever be sent for this update, so it is journaled as finished and a
+        # resumed run does not wait for it. A video with other updates still queued is
+        # journaled once those are sent.
+        if self.on_updated and id not in self.pending:
+            self.on_updated(id)
+
+    def update_item(self, id, nmu, vid_type, lang):
+        new_media_url = nmu
+        if vid_type == 'subtitle':
+            lang_in_subs = False
+            example_sub = {}
+            subtitles = self._get_subtitles(id)
+            if not subtitles:
+                print(f"No existing subtitles found for ID {id} in ElasticSearch. Continuing without adding new subtitles to ID.")
+                self._skipped(id)
+                return 1
             for i, sub in enumerate(subtitles):
                 if i == 0:
                     example_sub = sub
                 if sub['lang'] == lang:
                     lang_in_subs = True
                     subtitles[i]['media_url'] = new_media_url
-        if not lang_in_subs and example_sub:
-            missing_sub = {}
-            missing_sub['ext'] = example_sub['ext']
-            missing_sub['url'] = example_sub['url'].replace("&fmt",f"&lang={lang}&fmt")
-            language_name = iso639_1_to_full_name.get(lang)
-            if language_name:
-                missing_sub['name'] = language_name
-            else:
-                dprint(f"Language name could not be found in language dictionary: {lang}")
-                missing_sub['name'] = "N/A"
-            missing_sub['lang'] = lang
-            missing_sub['source'] = "auto"
-            missing_sub['media_url'] = new_media_url
-            subtitles.append(missing_sub)
-        if subtitles:
-            source = {"doc": {"subtitles": subtitles}}
-    else:
-        source = {"doc": {"media_url": new_media_url}}
-    if args.DRY_RUN:
-        print(f"DRY_RUN:\tUpdating ElasticSearch values for {id}'s{' ' + lang + ' ' if lang else ' '}{vid_type} | {source}")
-    else:
-        print(f"Updating ElasticSearch values for {id}'s{' ' + lang + ' ' if lang else ' '}{vid_type}.")
-        res = ElasticWrap(f"ta_video/_update/{id}").post(data = source)
+            if not lang_in_subs and example_sub:
+                missing_sub = {}
+                missing_sub['ext'] = example_sub['ext']
+                missing_sub['url'] = example_sub['url'].replace("&fmt",f"&lang={lang}&fmt")
+                language_name = iso639_1_to_full_name.get(lang)
+                if language_name:
+                    missing_sub['name'] = language_name
+                else:
+                    dprint(f"Language name could not be found in language dictionary: {lang}")
+                    missing_sub['name'] = "N/A"
+                missing_sub['lang'] = lang
+                missing_sub['source'] = "auto"
+                missing_sub['media_url'] = new_media_url
+                subtitles.append(missing_sub)
+            doc = {"subtitles": subtitles}
+        else:
+            doc = {"media_url": new_media_url}
+        if args.DRY_RUN:
+            vprint(f"DRY_RUN:\tUpdating ElasticSearch values for {id}'s{' ' + lang + ' ' if lang else ' '}{vid_type} | {{'doc': {doc}}}", required=True)
+            return
+        vprint(f"Queueing ElasticSearch update for {id}'s{' ' + lang + ' ' if lang else ' '}{vid_type}.")
+        self.pending.setdefault(id, {}).update(doc)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def seconds_until_due(self):
+        """Seconds until the queued updates have to be sent, or None if nothing is queued."""
+        if not self.pending:
+            return None
+        return max(0, self.last_flush + self.flush_interval - time.monotonic())
+
+    def flush_if_due(self):
+        if self.pending and self.seconds_until_due() == 0:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        lines = []
+        for id, doc in pending.items():
+            lines.append(json.dumps({"update": {"_index": "ta_video", "_id": id}}))
+            lines.append(json.dumps({"doc": doc}))
+        vprint(f"Updating ElasticSearch values for {len(pending)} videos.")
         try:
-            if res[1] == 200 and res[0]['_shards']['total'] == res[0]['_shards']['successful']:
-                print(f"ElasticSearch was updated successfully.")
-            else:
-                print(f"ElasticSearch was not updated successfully.")
+            res = es_request("post", "_bulk", data="\n".join(lines) + "\n", ndjson=True)
+            if res[1] != 200:
+                print(f"ElasticSearch was not updated successfully. Status {res[1]}: {res[0]}")
+                self.failed += len(pending)
+                return
+            for item in res[0]['items']:
+                result = item.get('update', {})
+                if result.get('status') in (200, 201):
+                    self.succeeded += 1
+                    if self.on_updated:
+                        self.on_updated(result.get('_id'))
+                    dprint(f"ElasticSearch was updated successfully for {result.get('_id')}.")
+                else:
+                    self.failed += 1
+                    print(f"ElasticSearch was not updated successfully for {result.get('_id')}: {result.get('error')}")
+                    # Client errors, such as a deleted video, fail the same way on every retry.
+                    # Rate limiting and server errors are left outstanding for --RESUME.
+                    status = result.get('status') or 0
+                    if 400 <= status < 500 and status != 429:
+                        self._skipped(result.get('_id'))
         except Exception as e:
+            self.failed += len(pending)
             print(f"Exception occurred during update of ElasticSearch: {e}")
 
-def migration(root, id, source_file, dest_file_obj):
-    if args.DRY_RUN:
-        print(f"DRY_RUN:\tDirectory would be created or confirmed as created here: {os.path.join(root, dest_file_obj['channel_id'])}")
-        print(f"DRY_RUN:\tMoving file `{source_file}` to `{dest_file_obj['expected_location']}`.")
-        nmu = '/'.join(dest_file_obj["expected_location"].split('/')[2:])
-        update_es_for_item(id, nmu, dest_file_obj['type'], dest_file_obj['lang'] if dest_file_obj.get('lang') else None)
-    else:
-        prep_directory(root, os.path.dirname(source_file), dest_file_obj["channel_id"])
-        print(f"Moving file `{source_file}` to `{dest_file_obj['expected_location']}`.")
-        shutil.move(source_file, dest_file_obj["expected_location"])
-        nmu = '/'.join(dest_file_obj["expected_location"].split('/')[2:])
-        update_es_for_item(id, nmu, dest_file_obj['type'], dest_file_obj['lang'] if dest_file_obj.get('lang') else None)
-
-def migrate_files(diffs, all_files, root):
-    flag_filesystem_rescan = False
+    def summary(self):
+        return f"ElasticSearch updates: {self.succeeded} succeeded, {self.failed} failed."
+
+COPY_CHUNK_SIZE = 8 * 1048576
+
+def _copy_range(source_fd, dest_fd, count):
+    # Copies within the kernel where possible: copy_file_range, then sendfile. Returns
+    # None when neither is available so the caller copies through userspace instead.
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(source_fd, dest_fd, count)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            return os.sendfile(dest_fd, source_fd, None, count)
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    return None
+
+def throttle(limiter):
+    if limiter:
+        metrics.add("sleep_seconds", limiter.acquire(COPY_CHUNK_SIZE), "copy_bandwidth")
+
+def hash_file(path, limiter=None):
+    checksum = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        while True:
+            throttle(limiter)
+            chunk = f.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                return checksum.hexdigest()
+            checksum.update(chunk)
+
+def copy_verified(source_file, dest_file, limiter=None):
+    """Moves a file across filesystems, removing the source only once the copy is verified.
+
+    The data is copied in the kernel when possible, then both files are read back and
+    their checksums compared; a userspace copy checksums the source in the same pass.
+    The copy is written to a uniquely named temporary file next to `dest_file` and renamed
+    into place, so `dest_file` never holds a partial copy. `limiter` is a TokenBucket of bytes that
+    caps the disk bandwidth used.
+    """
+    temp_fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(dest_file), prefix=f".{os.path.basename(dest_file)}.", suffix=".migrating")
+    source_checksum = None
+    try:
+        with open(source_file, 'rb') as source, os.fdopen(temp_fd, 'wb') as dest:
+            zero_copy = True
+            checksum = hashlib.blake2b()
+            while True:
+                throttle(limiter)
+                copied = _copy_range(source.fileno(), dest.fileno(), COPY_CHUNK_SIZE) if zero_copy else None
+                if copied is None:
+                    if zero_copy and source.tell() > 0:
+                        # The kernel copy stopped working part way, so start again in userspace.
+                        source.seek(0)
+                        dest.seek(0)
+                        dest.truncate()
+                    zero_copy = False
+                    chunk = source.read(COPY_CHUNK_SIZE)
+                    dest.write(chunk)
+                    checksum.update(chunk)
+                    copied = len(chunk)
+                if not copied:
+                    break
+            dest.flush()
+            os.fsync(dest.fileno())
+            if not zero_copy:
+                source_checksum = checksum.hexdigest()
+        if source_checksum is None:
+            source_checksum = hash_file(source_file, limiter)
+        if hash_file(temp_file, limiter) != source_checksum:
+            metrics.add("checksum_mismatches")
+            raise OSError(f"Checksum of the copy of `{source_file}` does not match. The source was left in place.")
+        shutil.copystat(source_file, temp_file)
+        os.replace(temp_file, dest_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(temp_file)
+        raise
+    dir_fd = os.open(os.path.dirname(dest_file), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    os.unlink(source_file)
+
+class FileMover(object):
+    """Moves files on worker pools, keeping renames and copies apart.
+
+    A move within one filesystem is a plain `os.rename` and goes to the rename pool.
+    A move across filesystems has to copy the data, so it goes to a separate, bounded
+    copy pool where each source device also has its own concurrency limit. Copies wait
+    in a queue per device and are only handed to the pool while their device is under
+    its limit, so no copy worker sits blocked while other devices have work. A rename
+    refused with EXDEV is handed to the copy pool as well.
+    """
+    def __init__(self, workers=4, copy_workers=2, copies_per_device=1, bandwidth=0):
+        # Shared by every copy, so the cap applies to the migration as a whole.
+        self.limiter = TokenBucket(bandwidth * 1048576, COPY_CHUNK_SIZE) if bandwidth > 0 else None
+        self.rename_executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="rename")
+        self.copy_executor = ThreadPoolExecutor(max_workers=max(1, copy_workers), thread_name_prefix="copy")
+        self.copies_per_device = max(1, copies_per_device)
+        self.copy_queues = {}
+        self.copies_running = {}
+        self.dir_devices = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        # Notified whenever a copy finishes, so `close` can wait for the queues to drain.
+        self.copies_done = threading.Condition(self.lock)
+
+    def _dir_device(self, path):
+        if path not in self.dir_devices:
+            self.dir_devices[path] = os.stat(path).st_dev
+        return self.dir_devices[path]
+
+    def submit(self, source_file, dest_file):
+        source_stat = os.stat(source_file)
+        # Completed by whichever pool ends up moving the file.
+        future = Future()
+        if source_stat.st_dev == self._dir_device(os.path.dirname(dest_file)):
+            self.rename_executor.submit(self._rename, future, source_file, dest_file, source_stat)
+        else:
+            self._submit_copy(future, source_file, dest_file, source_stat)
+        return future
+
+    def _submit_copy(self, future, source_file, dest_file, source_stat):
+        with self.lock:
+            self.copy_queues.setdefault(source_stat.st_dev, collections.deque()).append((future, source_file, dest_file, source_stat))
+            self._start_copies(source_stat.st_dev)
+
+    def _start_copies(self, dev):
+        # Called with the lock held.
+        copy_queue = self.copy_queues[dev]
+        while copy_queue and self.copies_running.get(dev, 0) < self.copies_per_device:
+            self.copies_running[dev] = self.copies_running.get(dev, 0) + 1
+            self.copy_executor.submit(self._copy, *copy_queue.popleft())
+
+    def _rename(self, future, source_file, dest_file, source_stat):
+        started = time.monotonic()
+        try:
+            os.rename(source_file, dest_file)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                # Two mount points of one filesystem, such as Docker bind mounts, share a
+                # device but cannot be renamed across, so the file is copied instead.
+                self._submit_copy(future, source_file, dest_file, source_stat)
+            else:
+                future.set_exception(e)
+            return
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        self._finish(future, dest_file, source_stat, started, False)
+
+    def _copy(self, future, source_file, dest_file, source_stat):
+        started = time.monotonic()
+        try:
+            copy_verified(source_file, dest_file, self.limiter)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            self._finish(future, dest_file, source_stat, started, True)
+        finally:
+            with self.lock:
+                self.copies_running[source_stat.st_dev] -= 1
+                self._start_copies(source_stat.st_dev)
+                self.copies_done.notify_all()
+
+    def _finish(self, future, dest_file, source_stat, started, copy):
+        finished = time.monotonic()
+        method = "copy" if copy else "rename"
+        metrics.add("files_moved", label=method)
+        metrics.add("bytes_moved", source_stat.st_size, method)
+        metrics.observe("move_seconds", finished - started, method)
+        with self.lock:
+            device = self.stats.setdefault(source_stat.st_dev, {"files": 0, "bytes": 0, "copies": 0, "started": started, "finished": finished})
+            device["files"] += 1
+            device["bytes"] += source_stat.st_size
+            device["copies"] += 1 if copy else 0
+            device["started"] = min(device["started"], started)
+            device["finished"] = max(device["finished"], finished)
+        future.set_result(dest_file)
+
+    def close(self):
+        self.rename_executor.shutdown(wait=True)
+        # Queued copies are submitted as earlier ones finish, so the pool is only shut
+        # down once every queue has drained.
+        with self.copies_done:
+            self.copies_done.wait_for(lambda: not any(self.copies_running.values()))
+        self.copy_executor.shutdown(wait=True)
+
+    def summary(self):
+        lines = []
+        for dev, device in sorted(self.stats.items()):
+            elapsed = max(device["finished"] - device["started"], 1e-6)
+            lines.append(f"Device {os.major(dev)}:{os.minor(dev)}: {device['files']} files ({device['copies']} copied), {device['bytes'] / 1048576:.1f} MB in {elapsed:.1f}s | {device['files'] / elapsed:.1f} files/s, {device['bytes'] / 1048576 / elapsed:.1f} MB/s")
+        return "\n".join(lines) if lines else "No files were moved."
+
+
+class MigrationJournal(object):
+    """Append-only, fsync'd record of the moves and ElasticSearch updates of a migration.
+
+    Every planned move is written before any file is touched, and every completed move
+    and ElasticSearch update is appended as it happens, so an interrupted migration can
+    be resumed from the journal alone.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.next_key = 0
+
+    def start(self):
+        if os.path.exists(self.path):
+            # Kept so the earlier run can still be inspected or resumed by hand.
+            os.replace(self.path, self.path + ".prev")
+        self.file = open(self.path, 'w')
+        self._write({"event": "start", "time": time.time()})
+
+    def reopen(self, next_key):
+        self.next_key = next_key
+        self.file = open(self.path, 'a')
+        self._write({"event": "resume", "time": time.time()})
+
+    def _write(self, record, sync=True):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def plan(self, operations):
+        keys = []
+        for id, source_file, dest_file_obj in operations:
+            self._write({"event": "planned", "key": self.next_key, "id": id, "source": source_file, "dest": dest_file_obj.to_dict()}, sync=False)
+            keys.append(self.next_key)
+            self.next_key += 1
+        os.fsync(self.file.fileno())
+        return keys
+
+    def moved(self, key):
+        self._write({"event": "moved", "key": key})
+
+    def updated(self, id):
+        self._write({"event": "updated", "id": id})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def load(self):
+        """Replays the journal. Returns the planned operations by key, the keys that were moved,
+        and the keys whose ElasticSearch update is still outstanding, grouped by video ID."""
+        planned = {}
+        moved = set()
+        es_pending = {}
+        if not os.path.exists(self.path):
+            return planned, moved, es_pending
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partially written last line from an interrupted run.
+                    continue
+                if record["event"] == "planned":
+                    record["dest"] = FileRecord.from_dict(record["dest"])
+                    planned[record["key"]] = record
+                elif record["event"] == "moved":
+                    if record["key"] not in planned:
+                        print(f"WARNING: Skipping a completed move in `{self.path}` whose planned move is missing or corrupt.")
+                        continue
+                    moved.add(record["key"])
+                    es_pending.setdefault(planned[record["key"]]["id"], set()).add(record["key"])
+                elif record["event"] == "updated":
+                    es_pending.pop(record["id"], None)
+        return planned, moved, es_pending
+
+    def outstanding(self):
+        """Returns the number of unfinished moves and outstanding ElasticSearch updates in the journal."""
+        planned, moved, es_pending = self.load()
+        return len(planned) - len(moved), len(es_pending)
+
+
+class Migrator(object):
+    """Moves files and updates ElasticSearch for a list of migration operations.
+
+    Bundles the directory preparation, file moves, bulk ElasticSearch updates and the
+    journal used during a migration so every way of running one shares them.
+    """
+    def __init__(self, root, es_video_ids, journal=None):
+        self.root = root
+        self.journal = journal
+        self.es_updater = BulkUpdater(es_video_ids, args.ES_BULK_SIZE, args.ES_BULK_INTERVAL, on_updated=journal.updated if journal else None)
+        self.mover = FileMover(args.MOVE_WORKERS, args.COPY_WORKERS, args.COPIES_PER_DEVICE, args.COPY_BANDWIDTH)
+        self.preparer = DirectoryPreparer(root, args.PREP_WORKERS)
+
+    def run(self, operations, keys=None, track_progress=True):
+        """Moves every `(video_id, source_file, dest_file_obj)` operation and queues its ElasticSearch update.
+
+        The update for a file is only queued once its move has finished successfully.
+        """
+        if track_progress:
+            progress.start("Migrating", "files", len(operations))
+        try:
+            self._run(operations, keys, track_progress)
+        finally:
+            if track_progress:
+                progress.finish()
+
+    def _run(self, operations, keys, track_progress):
+        root = self.root
+        futures = {}
+        if not args.DRY_RUN:
+            self.preparer.prepare_all((dest_file_obj.channel_id, os.path.dirname(source_file)) for _, source_file, dest_file_obj in operations)
+            if self.journal and keys is None:
+                keys = self.journal.plan(operations)
+        for i, (id, source_file, dest_file_obj) in enumerate(operations):
+            if args.DRY_RUN:
+                vprint(f"DRY_RUN:\tDirectory would be created or confirmed as created here: {os.path.join(root, dest_file_obj.channel_id)}", required=True)
+                vprint(f"DRY_RUN:\tMoving file `{source_file}` to `{dest_file_obj.expected_location}`.", required=True)
+                self.update_es(id, dest_file_obj)
+                if track_progress:
+                    progress.advance()
+                continue
+            try:
+                self.preparer.prepare(dest_file_obj.channel_id, os.path.dirname(source_file))
+                vprint(f"Moving file `{source_file}` to `{dest_file_obj.expected_location}`.")
+                future = self.mover.submit(source_file, dest_file_obj.expected_location)
+                futures[future] = (keys[i] if keys else None, id, dest_file_obj)
+            except Exception as e:
+                print(f"An issue occurred during the migration of files for ID {id}. Please review the exception: {e}")
+                if track_progress:
+                    progress.advance()
+        remaining = set(futures)
+        while remaining:
+            # Wakes up when updates are due, so a slow copy never holds back the updates queued before it.
+            done, remaining = wait(remaining, timeout=self.es_updater.seconds_until_due(), return_when=FIRST_COMPLETED)
+            for future in done:
+                key, id, dest_file_obj = futures[future]
+                if track_progress:
+                    progress.advance()
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"An issue occurred during the migration of files for ID {id}. Please review the exception: {e}")
+                    continue
+                if self.journal and key is not None:
+                    self.journal.moved(key)
+                self.update_es(id, dest_file_obj)
+            self.es_updater.flush_if_due()
+
+    def update_es(self, id, dest_file_obj):
+        nmu = '/'.join(dest_file_obj.expected_location.split('/')[2:])
+        lang = dest_file_obj.lang if dest_file_obj.lang else None
+        self.es_updater.update_item(id, nmu, dest_file_obj.type.value, lang)
+
+    def close(self):
+        try:
+            self.mover.close()
+            self.es_updater.flush()
+        finally:
+            if self.journal:
+                self.journal.close()
+
+    def summary(self):
+        return "\n".join([self.preparer.summary(), self.mover.summary(), self.es_updater.summary()])
+
+
+class MigrationPipeline(object):
+    """Migrates videos that are in both ElasticSearch and the filesystem while the scan runs.
+
+    The scan puts the records of each such video on a bounded queue as soon as they are
+    built, and a single thread takes them off in batches and runs them through the
+    Migrator. When the queue is full the scan waits, so it never gets far ahead of the
+    moves. Every other category is still left until the comparison is complete.
+    """
+    BATCH_SIZE = 100
+
+    def __init__(self, migrator, queue_size=1000):
+        self.migrator = migrator
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        # Source paths relative to SOURCE_DIR, which stay the same however the records are read back.
+        self.submitted = set()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="pipeline")
+        self.thread.start()
+
+    def put(self, video_id, records):
+        """Queues the records of one video, waiting while the queue is full."""
+        self.submitted.update(file.original for file in records)
+        self.queue.put((video_id, records))
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if self.error:
+                self._defer(batch)
+                continue
+            operations = []
+            for video_id, records in batch:
+                vprint(f"At least 1 file for {video_id} was detected on your filesystem and in ElasticSearch. Migrating it while the scan continues.")
+                for file in records:
+                    if file.original != file.expected:
+                        operations.append((video_id, file.original_location, file))
+                    else:
+                        vprint(f"No migration necessary for `{file.original_location}`. File is already using the expected naming format.")
+            if not operations:
+                continue
+            try:
+                # The scan owns the progress status while it runs, so these moves only show in the log.
+                self.migrator.run(operations, track_progress=False)
+            except Exception as e:
+                # The queue keeps being drained so the scan is never blocked.
+                print(f"The pipelined migration stopped. Remaining videos will be migrated after the comparison instead: {e}")
+                self.error = e
+                self._defer(batch)
+
+    def _defer(self, batch):
+        # Hands the videos back to the migration that follows the comparison.
+        for _, records in batch:
+            self.submitted.difference_update(file.original for file in records)
+
+    def close(self):
+        """Waits for every queued video to be migrated."""
+        self.queue.put(None)
+        self.thread.join()
+
+def resume_migration(root):
+    """Finishes the moves and ElasticSearch updates left outstanding in the migration journal."""
+    journal = MigrationJournal(args.JOURNAL_FILE)
+    planned, moved, es_pending = journal.load()
+    if not planned:
+        print(f"No migration journal found at `{args.JOURNAL_FILE}`. Nothing to resume.")
+        return
+    operations = []
+    keys = []
+    recovered = []
+    for key, record in planned.items():
+        if key in moved:
+            continue
+        if os.path.exists(record["source"]):
+            operations.append((record["id"], record["source"], record["dest"]))
+            keys.append(key)
+        elif os.path.exists(record["dest"].expected_location):
+            # Interrupted between the move and its journal entry.
+            es_pending.setdefault(record["id"], set()).add(key)
+            recovered.append(key)
+        else:
+            print(f"Unable to resume the migration of `{record['source']}`. Neither it nor `{record['dest'].expected_location}` exists.")
+    print(f"Resuming migration from `{args.JOURNAL_FILE}`: {len(operations)} moves and {len(es_pending)} ElasticSearch updates outstanding, {len(moved)} moves already complete and {len(recovered)} found completed on disk.")
+    if not operations and not es_pending:
+        return
+    # Only videos with outstanding work are read back from ElasticSearch.
+    es_video_ids = get_videos_from_es(set(es_pending) | set(id for id, _, _ in operations), args.ES_BATCH_SIZE)
+    if not args.DRY_RUN:
+        journal.reopen(max(planned) + 1)
+        for key in recovered:
+            journal.moved(key)
+    migrator = Migrator(root, es_video_ids, journal if not args.DRY_RUN else None)
+    try:
+        for id, video_keys in es_pending.items():
+            for key in sorted(video_keys):
+                migrator.update_es(id, planned[key]["dest"])
+        migrator.run(operations, keys)
+    finally:
+        migrator.close()
+    if not args.DRY_RUN:
+        print(migrator.summary())
+
+class MigrationPlan(object):
+    """Migration operations saved by one run to be executed by a later one.
+
+    Each operation keeps the inode, size and mtime of its source file when the plan was
+    written. Executing the plan only has to stat every source to confirm it has not
+    changed, instead of scanning and comparing the whole library again.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, root, operations):
+        count = 0
+        with gzip.open(f"{self.path}.tmp", 'wt') as f:
+            f.write(json.dumps({"version": self.VERSION, "source_dir": root, "created": time.time(), "operations": len(operations)}) + "\n")
+            for id, source_file, dest_file_obj in operations:
+                try:
+                    source_stat = os.stat(source_file)
+                except OSError as e:
+                    print(f"Leaving `{source_file}` out of the plan: {e}")
+                    continue
+                f.write(json.dumps([id, relative_to_source(source_file), dest_file_obj.to_list(), source_stat.st_ino, source_stat.st_size, source_stat.st_mtime_ns]) + "\n")
+                count += 1
+        os.replace(f"{self.path}.tmp", self.path)
+        print(f"Wrote {count} migration operations to the plan `{self.path}`.")
+
+    def load(self):
+        """Returns the plan's header and its `(video_id, source_file, dest_file_obj, inode, size, mtime)` entries."""
+        with gzip.open(self.path, 'rt') as f:
+            header = json.loads(f.readline())
+            if header.get("version") != self.VERSION:
+                raise ValueError(f"Unsupported plan version {header.get('version')}")
+            entries = []
+            for line in f:
+                id, source, dest, inode, size, mtime = json.loads(line)
+                entries.append((id, os.path.join(args.SOURCE_DIR, source), FileRecord.from_list(dest), inode, size, mtime))
+        return header, entries
+
+
+def execute_plan(root):
+    """Runs the operations of a plan written by an earlier run, skipping files that changed since."""
+    try:
+        header, entries = MigrationPlan(args.EXECUTE_PLAN).load()
+    except (OSError, ValueError) as e:
+        print(f"Unable to read the migration plan `{args.EXECUTE_PLAN}`: {e}")
+        return
+    if os.path.normpath(header["source_dir"]) != os.path.normpath(root):
+        print(f"The migration plan `{args.EXECUTE_PLAN}` was written for `{header['source_dir']}`, not `{root}`. Exiting.")
+        return
+    operations = []
+    for id, source_file, dest_file_obj, inode, size, mtime in entries:
+        try:
+            source_stat = os.stat(source_file)
+        except OSError:
+            print(f"Skipping `{source_file}`. It no longer exists.")
+            continue
+        if (source_stat.st_ino, source_stat.st_size, source_stat.st_mtime_ns) != (inode, size, mtime):
+            print(f"Skipping `{source_file}`. It changed after the plan was written.")
+            continue
+        operations.append((id, source_file, dest_file_obj))
+    print(f"Executing migration plan `{args.EXECUTE_PLAN}` from {time.ctime(header['created'])}: {len(operations)} of {len(entries)} operations are still valid.")
+    if not operations:
+        return
+    # Only videos in the plan are read back from ElasticSearch.
+    es_video_ids = get_videos_from_es(set(id for id, _, _ in operations), args.ES_BATCH_SIZE)
+    migrator = start_migration(root, es_video_ids)
+    try:
+        migrator.run(operations)
+    finally:
+        migrator.close()
+    print("Ending the migration process.")
+    if not args.DRY_RUN:
+        print(migrator.summary())
+
+
+def plan_migration(diffs, all_files, root, sniffer=None, pipelined=None):
+    """Works out every move of the migration from the comparison results.
+
+    Returns the `(video_id, source_file, dest_file_obj)` operations, and the videos that
+    only a filesystem rescan can resolve.
+    """
     flag_filesystem_rescan_list = []
+    operations = []
+    if sniffer and diffs.get("InESNotFS"):
+        # Queue every candidate up front so the reads overlap.
+        for video, entry in diffs["InESNotFS"].items():
+            if entry.secondary_result == "Secondary Search Found Result":
+                for file_fs in check_filesystem_for_video_ids(all_files, [video]):
+                    sniffer.classify(file_fs)
     if diffs.get("InESNotFS"):
+        # Several files can match the same ElasticSearch record, so moves are grouped by destination first.
+        by_destination = {}
         for video in diffs["InESNotFS"].keys():
-            if diffs["InESNotFS"][video].get("secondary_result") and diffs["InESNotFS"][video]["secondary_result"] == "Secondary Search Found Result":
-                print(f"At least 1 file for {video} was detected on your filesystem. Attempting to migrate those files to the new naming scheme.")
+            if diffs["InESNotFS"][video].secondary_result == "Secondary Search Found Result":
+                vprint(f"At least 1 file for {video} was detected on your filesystem. Attempting to migrate those files to the new naming scheme.")
                 files_fs = check_filesystem_for_video_ids(all_files, [video])
-                for file_fs in files_fs:
-                    file_fs_type = None
-                    if args.GUESS_TYPES:
-                        try:
-                            if mimetypes.guess_type(file_fs)[0] == None:
-                                with open(file_fs, 'r') as f:
-                                    firstline = f.readline().strip('\n')
-                                if "WEBVTT" in firstline:
-                                    vid_type = 'subtitle'
-                                else:
-                                    vid_type = 'other'
-                            elif "video" in mimetypes.guess_type(file_fs)[0]:
-                                vid_type = 'video'
-                            else:
-                                vid_type = 'other'
-                        except TypeError as e:
-                            vid_type = 'other'
-                    else:
-                        if os.path.splitext(file_fs)[-1] in ['.mp4']:
-                                vid_type = 'video'
-                        elif os.path.splitext(file_fs)[-1] in ['.vtt']:
-                            vid_type = 'subtitle'
+                if sniffer:
+                    # Files the scan already sniffed are answered from its results.
+                    sniffed = [sniffer.classify(file_fs).result() for file_fs in files_fs]
+                else:
+                    sniffed = [type_from_extension(file_fs) for file_fs in files_fs]
+                for file_fs, (file_fs_type, file_fs_lang) in zip(files_fs, sniffed):
+                    matches = [file_es for file_es in diffs["InESNotFS"][video].details if file_es.type == file_fs_type and (file_fs_type != FileType.SUBTITLE or file_es.lang == file_fs_lang)]
+                    if not matches:
+                        print(f"Unable to match `{file_fs}` to a file of {video} in ElasticSearch. No migration will be attempted for it.")
+                    for file_es in matches[:1]:
+                        if file_fs != file_es.expected_location and file_es.original != file_es.expected:
+                            by_destination.setdefault(file_es.expected_location, []).append((video, file_fs, file_es))
                         else:
-                            vid_type = 'other'
-                    for file_es in diffs["InESNotFS"][video]["details"]:
-                        try:
-                            if file_fs != file_es["expected_location"] and file_es["original_location"] != file_es["expected_location"] and file_fs_type == file_es["type"]:
-                                migration(root, video, file_fs, file_es)
-                            else:
-                                print(f"No migration necessary for `{file_fs}`. File is already using the expected naming format.")
-                        except Exception as e:
-                            print(f"An issue occurred during the migration of files for ID {video}. Please review the exception: {e}")
-                            continue
-            elif diffs["InESNotFS"][video].get("secondary_result") and diffs["InESNotFS"][video]["secondary_result"] == "Not Found In Filesystem":
+                            vprint(f"No migration necessary for `{file_fs}`. File is already using the expected naming format.")
+            elif diffs["InESNotFS"][video].secondary_result == "Not Found In Filesystem":
                 print(f"Files for {video} do not exist in filesystem. A filesystem rescan will remove video {video} from your TubeArchivist instance. If the videos are present elsewhere in your filesystem, please add them to `{root}`.")
-                flag_filesystem_rescan = True
                 flag_filesystem_rescan_list.append(video)
                 continue
             else:
                 print(f"Files for {video} did not meet appropriate criteria. Please review the JSON output and determine why this occurred.")
+        for destination, candidates in by_destination.items():
+            if len(candidates) > 1:
+                sources = ", ".join(f"`{file_fs}`" for _, file_fs, _ in candidates)
+                print(f"Unable to migrate {sources}. They would all be moved to `{destination}`. No migration will be attempted for them.")
+                continue
+            operations.extend(candidates)
     if diffs.get("InESInFS"):
         for video in diffs["InESInFS"].keys():
-            print(f"At least 1 file for {video} was detected on your filesystem and in ElasticSearch. Attempting to migrate to the new naming scheme.")
-            for file in diffs["InESInFS"][video]["details"]:
-                try:
-                    if file["original_location"] != file["expected_location"]:
-                        migration(root, video, file['original_location'], file)
-                    else:
-                        print(f"No migration necessary for `{file['original_location']}`. File is already using the expected naming format.")
-                except Exception as e:
-                    print(f"An issue occurred during the migration of files for ID {video}. Please review the exception: {e}")
+            # Files already migrated during the scan in pipelined mode are skipped.
+            files = [file for file in diffs["InESInFS"][video].details if not pipelined or file.original not in pipelined]
+            if not files:
+                continue
+            vprint(f"At least 1 file for {video} was detected on your filesystem and in ElasticSearch. Attempting to migrate to the new naming scheme.")
+            for file in files:
+                if file.original != file.expected:
+                    operations.append((video, file.original_location, file))
+                else:
+                    vprint(f"No migration necessary for `{file.original_location}`. File is already using the expected naming format.")
+    return operations, flag_filesystem_rescan_list
+
+def migrate_files(diffs, operations, flag_filesystem_rescan_list, migrator):
+    migrator.run(operations)
     if diffs.get("InFSNotES"):
-        if flag_filesystem_rescan:
+        if flag_filesystem_rescan_list:
             print(f"A filesystem rescan is expected to be performed to add these videos to your TubeArchivist instance. It was noted that there are some videos in ElasticSearch that do not exist in your filesystem. Please retain those records to download, import, or migrate those videos again in the future.")
             print(flag_filesystem_rescan_list)
             print("No action taken at this time. Please perform the action from within the TubeArchivist GUI.")
@@ -623,18 +2993,104 @@ def main():
     if not os.path.exists(source_dir):
         print(f"The directory `{source_dir}` does not exist. Exiting.")
         return 1
-    video_files, all_files = review_filesystem(source_dir)
+    progress.configure(args.PROGRESS_INTERVAL, args.VERBOSE, args.LOG_FILE)
+    try:
+        run(source_dir)
+    finally:
+        progress.close()
+        # Written even when the run fails, to show where it spent its time.
+        print(metrics.summary())
+        metrics.write(args.METRICS_FILE, args.PROMETHEUS_FILE)
 
-    diffs = compare_es_filesystem(video_files, all_files, source_dir)
-    if args.PERFORM_MIGRATION:
-        if args.DRY_RUN:
-            print("This is a dry-run of the migration action and should not perform any filesystem activities. Please review all DRY_RUN outputs before running without this flag.")
-        else:
-            print("This is a destructive action and could cause loss of data if interrupted. Giving ten seconds before initiating migration action...")
-            time.sleep(10)
-        print("Starting the migration process. PLEASE DO NOT INTERRUPT THIS PROCESS.")
-        migrate_files(diffs, all_files, source_dir)
+# Seconds given to cancel before a migration starts touching files.
+MIGRATION_BARRIER = 10
+
+def start_migration(root, es_video_ids):
+    if args.DRY_RUN:
+        print("This is a dry-run of the migration action and should not perform any filesystem activities. Please review all DRY_RUN outputs before running without this flag.")
+    else:
+        print(f"This is a destructive action and could cause loss of data if interrupted. Giving {MIGRATION_BARRIER} seconds before initiating migration action...")
+        time.sleep(MIGRATION_BARRIER)
+        metrics.add("sleep_seconds", MIGRATION_BARRIER, "migration_barrier")
+    print("Starting the migration process. PLEASE DO NOT INTERRUPT THIS PROCESS.")
+    journal = None
+    if not args.DRY_RUN:
+        journal = MigrationJournal(args.JOURNAL_FILE)
+        journal.start()
+    return Migrator(root, es_video_ids, journal)
+
+def run(source_dir):
+    if args.RESUME:
+        print("Resuming an interrupted migration. PLEASE DO NOT INTERRUPT THIS PROCESS.")
+        with metrics.phase("resume_migration"):
+            resume_migration(source_dir)
+        print("Ending the migration process.")
+        return
+    if (args.PERFORM_MIGRATION or args.EXECUTE_PLAN) and not args.DRY_RUN and not args.DISCARD_JOURNAL:
+        unfinished_moves, pending_updates = MigrationJournal(args.JOURNAL_FILE).outstanding()
+        if unfinished_moves or pending_updates:
+            print(f"The migration journal `{args.JOURNAL_FILE}` has {unfinished_moves} unfinished moves and {pending_updates} outstanding ElasticSearch updates from an earlier run. Use --RESUME to finish the earlier run, or --DISCARD_JOURNAL to start a new one anyway. Exiting.")
+            return
+    if args.EXECUTE_PLAN:
+        with metrics.phase("execute_plan"):
+            execute_plan(source_dir)
+        return
+    cache = ChannelCache(args.CACHE_FILE, enabled=not args.NO_CACHE, clear=args.CLEAR_CACHE)
+    store = ComparisonStore(args.COMPARE_FILE) if args.DISK_COMPARE else None
+    # ElasticSearch is read once up front so the filesystem review only has to ask
+    # YouTube about videos that are genuinely missing from it.
+    with metrics.phase("get_video_ids_from_es"):
+        es_video_ids = get_video_ids_from_es(store)
+    resolver = ChannelResolver(args.USE_YTDLP, args.YTDLP_SLEEP, args.YTDLP_BURST, args.YTDLP_WORKERS, args.YTDLP_RETRIES, es_fallback=False, probe=args.YTDLP_PROBE)
+    progress.queue_depth = resolver.queue_depth
+    snapshot = ScanSnapshot(args.SNAPSHOT_FILE, source_dir, args.GUESS_TYPES)
+    if not args.FULL_SCAN:
+        snapshot.load()
+    sniffer = ContentSniffer(args.SNIFF_WORKERS) if args.GUESS_TYPES else None
+    report = ReportWriter(args.OUTPUT_FORMAT, args.OUTPUT_FILE)
+    migrator = None
+    pipeline = None
+    if args.PERFORM_MIGRATION and args.PIPELINE:
+        # Moves start during the scan, so the warning and barrier come before it.
+        migrator = start_migration(source_dir, es_video_ids)
+        pipeline = MigrationPipeline(migrator, args.PIPELINE_QUEUE)
+    try:
+        try:
+            with metrics.phase("review_filesystem"):
+                video_files, all_files = review_filesystem(source_dir, resolver, cache, es_video_ids, snapshot, sniffer, pipeline, store)
+        finally:
+            progress.queue_depth = None
+            resolver.close()
+            cache.close()
+            if pipeline:
+                pipeline.close()
+
+        with metrics.phase("compare_es_filesystem"):
+            diffs = compare_es_filesystem(video_files, all_files, source_dir, es_video_ids, report, store)
+        if args.PERFORM_MIGRATION or args.WRITE_PLAN:
+            with metrics.phase("plan_migration"):
+                operations, rescan_list = plan_migration(diffs, all_files, source_dir, sniffer, pipeline.submitted if pipeline else None)
+            if args.WRITE_PLAN:
+                MigrationPlan(args.WRITE_PLAN).write(source_dir, operations)
+        if args.PERFORM_MIGRATION:
+            if migrator is None:
+                migrator = start_migration(source_dir, es_video_ids)
+            with metrics.phase("migrate_files"):
+                migrate_files(diffs, operations, rescan_list, migrator)
+    finally:
+        try:
+            if migrator:
+                migrator.close()
+        finally:
+            if store:
+                store.close()
+    if migrator:
         print("Ending the migration process.")
+        if not args.DRY_RUN:
+            print(migrator.summary())
+    if sniffer:
+        sniffer.close()
+    print(cache.summary())
 
 if __name__ == "__main__":
     print("Starting script...")
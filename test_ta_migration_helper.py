@@ -0,0 +1,192 @@
+"""Tests for ta_migration_helper, run against the benchmark's ElasticSearch and yt-dlp stand-ins."""
+import contextlib
+import errno
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+import ta_migration_benchmark as benchmark
+
+es = benchmark.StandInElasticsearch(0)
+youtube = benchmark.StandInYoutube(0)
+benchmark.install_stand_ins(es, youtube)
+
+import ta_migration_helper as helper
+
+CHANNEL_ID = "UCaaaaaaaaaaaaaaaaaaaaaa"
+VIDEO_ID = "AbCdEfGhIjK"
+
+
+class OrderedScandir(object):
+    """`os.scandir` with its entries sorted by name, so the walk order is fixed."""
+    scandir = os.scandir
+
+    def __init__(self, reverse):
+        self.reverse = reverse
+
+    def __call__(self, path):
+        return contextlib.nullcontext(iter(sorted(self.scandir(path), key=lambda entry: entry.name, reverse=self.reverse)))
+
+
+class HelperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.target)
+        self.source_dir = os.path.join(self.target, "youtube")
+        self.report = os.path.join(self.target, "report.json")
+        os.makedirs(self.source_dir)
+        es.docs.clear()
+        youtube.channels.clear()
+
+    def write(self, relative_path, content=b""):
+        path = os.path.join(self.source_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def run_helper(self, *helper_args):
+        sys.argv = [helper.__file__, "-d", self.source_dir, "-s", "0", "--STATE_DIR", self.target, "--OUTPUT_FILE", self.report, *helper_args]
+        helper.parse_args()
+        helper.metrics = helper.Metrics()
+        with contextlib.redirect_stdout(io.StringIO()):
+            helper.run(self.source_dir)
+        with open(self.report) as f:
+            return json.load(f)
+
+
+class ReviewFilesystemTest(HelperTestCase):
+    def test_channel_file_in_later_directory_resolves_queued_files(self):
+        # `A/` has no channel.id, so its file waits for a lookup that `B/channel.id` answers later.
+        self.write(f"A/20200101_{VIDEO_ID}_Title.mp4")
+        self.write(f"B/20200101_{VIDEO_ID}_Title.en.vtt", b"WEBVTT\n")
+        self.write("B/channel.id", f"{CHANNEL_ID}\n".encode())
+        for disk_compare in ([], ["--DISK_COMPARE"]):
+            for reverse in (False, True):
+                with self.subTest(disk_compare=disk_compare, reverse=reverse), mock.patch("os.scandir", OrderedScandir(reverse)):
+                    report = self.run_helper("--FULL_SCAN", "--CLEAR_CACHE", *disk_compare)
+                    details = report["InFSNotES"][VIDEO_ID]["details"]
+                    self.assertEqual(len(details), 2)
+                    self.assertEqual({det["channel_id"] for det in details}, {CHANNEL_ID})
+
+
+class CompareTest(HelperTestCase):
+    def test_es_only_videos_are_not_requested_again(self):
+        es.docs[VIDEO_ID] = {"youtube_id": VIDEO_ID, "media_url": f"Channel/20200101_{VIDEO_ID}_Title.mp4", "channel": {"channel_id": CHANNEL_ID},
+            "subtitles": [{"lang": "en", "media_url": f"Channel/20200101_{VIDEO_ID}_Title.en.vtt"}]}
+        for disk_compare in ([], ["--DISK_COMPARE"]):
+            with self.subTest(disk_compare=disk_compare), mock.patch.object(es, "mget", wraps=es.mget) as mget:
+                report = self.run_helper(*disk_compare)
+                self.assertEqual(mget.call_count, 0)
+                details = report["InESNotFS"][VIDEO_ID]["details"]
+                self.assertEqual(sorted(det["expected_location"] for det in details), [
+                    os.path.join(self.source_dir, CHANNEL_ID, f"{VIDEO_ID}.en.vtt"),
+                    os.path.join(self.source_dir, CHANNEL_ID, f"{VIDEO_ID}.mp4"),
+                ])
+
+
+class MigrationJournalTest(HelperTestCase):
+    def setUp(self):
+        super().setUp()
+        self.journal = os.path.join(self.target, "journal.jsonl")
+        helper.MIGRATION_BARRIER = 0
+
+    def test_skipped_subtitle_update_is_not_left_outstanding(self):
+        # The video has no subtitles in ElasticSearch, so moving one sends no update.
+        es.docs[VIDEO_ID] = {"youtube_id": VIDEO_ID, "media_url": f"{CHANNEL_ID}/{VIDEO_ID}.mp4", "channel": {"channel_id": CHANNEL_ID}, "subtitles": []}
+        self.write(f"Channel/20200101_{VIDEO_ID}_Title.en.vtt", b"WEBVTT\n")
+        self.run_helper("-M", "--JOURNAL_FILE", self.journal)
+        self.assertTrue(os.path.exists(os.path.join(self.source_dir, CHANNEL_ID, f"{VIDEO_ID}.en.vtt")))
+        self.assertEqual(helper.MigrationJournal(self.journal).outstanding(), (0, 0))
+        # A journal written before skipped updates were journaled is cleared by --RESUME.
+        with open(self.journal) as f:
+            lines = [line for line in f if json.loads(line)["event"] != "updated"]
+        with open(self.journal, 'w') as f:
+            f.writelines(lines)
+        self.assertEqual(helper.MigrationJournal(self.journal).outstanding(), (0, 1))
+        sys.argv = [helper.__file__, "-d", self.source_dir, "--STATE_DIR", self.target, "--JOURNAL_FILE", self.journal, "--RESUME"]
+        helper.parse_args()
+        with contextlib.redirect_stdout(io.StringIO()):
+            helper.run(self.source_dir)
+        self.assertEqual(helper.MigrationJournal(self.journal).outstanding(), (0, 0))
+
+    def test_missing_video_update_is_not_left_outstanding(self):
+        es.docs[VIDEO_ID] = {"youtube_id": VIDEO_ID, "media_url": f"Channel/20200101_{VIDEO_ID}_Title.mp4", "channel": {"channel_id": CHANNEL_ID}}
+        self.write(f"Channel/20200101_{VIDEO_ID}_Title.mp4")
+        sys.argv = [helper.__file__, "-d", self.source_dir, "--STATE_DIR", self.target, "--JOURNAL_FILE", self.journal]
+        helper.parse_args()
+        journal = helper.MigrationJournal(self.journal)
+        journal.start()
+        keys = journal.plan([(VIDEO_ID, os.path.join(self.source_dir, f"Channel/20200101_{VIDEO_ID}_Title.mp4"), helper.FileRecord(CHANNEL_ID, helper.FileType.VIDEO, None, "", ""))])
+        journal.moved(keys[0])
+        updater = helper.BulkUpdater({}, on_updated=journal.updated)
+        updater.pending[VIDEO_ID] = {"media_url": f"{CHANNEL_ID}/{VIDEO_ID}.mp4"}
+        with mock.patch.object(es, "bulk", return_value={"errors": True, "items": [{"update": {"_id": VIDEO_ID, "status": 404, "error": "document missing"}}]}), contextlib.redirect_stdout(io.StringIO()):
+            updater.flush()
+        journal.close()
+        self.assertEqual(updater.failed, 1)
+        self.assertEqual(journal.outstanding(), (0, 0))
+
+
+class FileMoverTest(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.target)
+        self.source = os.path.join(self.target, "source.mp4")
+        self.dest = os.path.join(self.target, "dest.mp4")
+        with open(self.source, 'wb') as f:
+            f.write(b"video" * 1000)
+
+    def test_rename_across_mount_points_is_copied(self):
+        # Bind mounts of one filesystem share a device, but refuse renames between them.
+        mover = helper.FileMover()
+        with mock.patch("os.rename", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            self.assertEqual(mover.submit(self.source, self.dest).result(timeout=10), self.dest)
+        mover.close()
+        self.assertFalse(os.path.exists(self.source))
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), b"video" * 1000)
+        self.assertEqual(sum(device["copies"] for device in mover.stats.values()), 1)
+
+    def test_copies_for_a_busy_device_do_not_hold_workers(self):
+        release = threading.Event()
+
+        def copy(source_file, dest_file, limiter=None):
+            if source_file.startswith("busy"):
+                release.wait(10)
+
+        mover = helper.FileMover(copy_workers=2, copies_per_device=1)
+        futures = {}
+        with mock.patch.object(helper, "copy_verified", copy):
+            for name, dev in [("busy-1", 1), ("busy-2", 1), ("idle-1", 2)]:
+                futures[name] = helper.Future()
+                mover._submit_copy(futures[name], name, name, types.SimpleNamespace(st_dev=dev, st_size=0))
+            # The second copy of the busy device waits in its queue, not in a worker.
+            self.assertEqual(futures["idle-1"].result(timeout=5), "idle-1")
+            self.assertFalse(futures["busy-2"].done())
+            release.set()
+            mover.close()
+        self.assertTrue(all(future.done() for future in futures.values()))
+
+
+class DirectoryPreparerTest(unittest.TestCase):
+    def test_failed_directory_is_tried_once_per_run(self):
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        preparer = helper.DirectoryPreparer(target)
+        with mock.patch("os.chown", side_effect=PermissionError(errno.EPERM, "Operation not permitted")) as chown, contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(3):
+                preparer.prepare(CHANNEL_ID, target)
+        self.assertEqual(chown.call_count, 1)
+        self.assertEqual((preparer.created, preparer.failed), (0, 1))
+        self.assertNotIn(CHANNEL_ID, preparer.prepared)
+
+
+if __name__ == "__main__":
+    unittest.main()